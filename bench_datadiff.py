@@ -0,0 +1,399 @@
+"""
+Timings and peak memory of datadiff's hot paths, on generated data.
+
+Run with ``python bench_datadiff.py``, or ``python bench_datadiff.py seq dict`` for
+just the benchmarks with those words in their function names.  To catch
+regressions, save the results of a baseline run with ``--save base.json`` and
+check a later run against them with ``--compare base.json``, which fails if any
+timing got more than ``--tolerance`` (default 25%) slower.
+"""
+import copy
+import json
+import optparse
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datadiff import (DataDiff, DiffStats, DigestIndex, diff, diff_files, diff_set_counts, diff_stream, hashable,
+                      patch, unified_diff_strings)
+
+# name -> {'seconds': ..., 'peak_mb': ...} of this run
+results = {}
+
+
+def best_of(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def memory_use(fn):
+    """
+    Memory still allocated after running fn (i.e. held by its result), and the peak
+    """
+    tracemalloc.start()
+    try:
+        result = fn()
+        return tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+def report(name, seconds):
+    results.setdefault(name, {})['seconds'] = seconds
+    sys.stdout.write('%-40s %9.4fs\n' % (name, seconds))
+
+def report_memory(name, size):
+    results.setdefault(name, {})['peak_mb'] = size / 1024.0 / 1024
+    sys.stdout.write('%-40s %8.1fMB\n' % (name, size / 1024.0 / 1024))
+
+def report_size(name, size):
+    results.setdefault(name, {})['size_kb'] = size / 1024.0
+    sys.stdout.write('%-40s %8.1fKB\n' % (name, size / 1024.0))
+
+def measure(name, fn, repeat=3):
+    """
+    Report the best time of fn, and its peak memory from a separate traced run
+    """
+    seconds = best_of(fn, repeat)
+    held, peak = memory_use(fn)
+    results[name] = {'seconds': seconds, 'peak_mb': peak / 1024.0 / 1024}
+    sys.stdout.write('%-40s %9.4fs %8.1fMB\n' % (name, seconds, peak / 1024.0 / 1024))
+
+
+def long_list_few_edits(n=20000, edits=20):
+    a = list(range(n))
+    b = list(a)
+    for i in range(0, n, n // edits):
+        b[i] = -b[i]
+    return a, b
+
+def bench_seq_matchers():
+    for n in (2000, 20000, 200000):
+        a, b = long_list_few_edits(n)
+        for matcher in ('difflib', 'myers'):
+            seconds = best_of(lambda: diff(a, b, matcher=matcher))
+            report('diff_seq %s n=%d' % (matcher, n), seconds)
+    a = list(range(4000))
+    b = list(range(4000, 8000))
+    report('diff_seq myers n=4000 unrelated', best_of(lambda: diff(a, b, matcher='myers')))
+
+def deep_nesting(depth, leaf):
+    x = [leaf, 1, 2]
+    for i in range(depth):
+        x = [x, {'k': i}, i]
+    return x
+
+def bench_deep_nesting():
+    for depth in (100, 1000, 10000):
+        a = deep_nesting(depth, 1)
+        b = deep_nesting(depth, 2)
+        report('diff+str deep nesting depth=%d' % depth, best_of(lambda: str(diff(a, b))))
+
+def tree(arity, depth, leaves):
+    if depth == 0:
+        return next(leaves)
+    return [tree(arity, depth - 1, leaves) for _ in range(arity)]
+
+def bench_nested_lists_one_edit():
+    # a and b are built separately, so no subtree is shared between them
+    for name, arity, depth in (('6-ary depth=6', 6, 6), ('binary depth=15', 2, 15)):
+        a = tree(arity, depth, iter(range(10 ** 6)))
+        b = tree(arity, depth, iter(range(10 ** 6)))
+        leaf = b
+        for _ in range(depth - 1):
+            leaf = leaf[-1]
+        leaf[0] = -1
+        report('diff_seq tree %s one edit' % name, best_of(lambda: diff(a, b), repeat=5))
+    n = 30000
+    a = [[i, i + 1, 'x%d' % i] for i in range(n)]
+    b = [[i, i + 1, 'x%d' % i] for i in range(n)]
+    b[n // 2][1] = -1
+    measure('diff_seq %d small lists one edit' % n, lambda: diff(a, b), repeat=5)
+
+def records(n, changed=()):
+    return [dict(id=i, name='record %d' % i, value=(i in changed))
+            for i in range(n)]
+
+def bench_keyed_records():
+    n = 20000
+    a = records(n)
+    b = records(n, changed=range(0, n, 100))
+    report('diff_seq records n=%d positional' % n, best_of(lambda: diff(a, b), repeat=1))
+    report('diff_seq records n=%d key=id' % n, best_of(lambda: diff(a, b, key='id')))
+
+def bench_parallel_dict():
+    n = 20000
+    a = dict(('doc%d' % i, dict(id=i, tags=['x', 'y', i], body=records(5)))
+             for i in range(n))
+    b = dict(('doc%d' % i, dict(id=i, tags=['x', 'y', -i], body=records(5)))
+             for i in range(n))
+    report('diff_dict n=%d serial' % n, best_of(lambda: diff(a, b), repeat=1))
+    for workers in (1, 2, 4, 8):
+        report('diff_dict n=%d workers=%d' % (n, workers),
+               best_of(lambda: diff(a, b, workers=workers), repeat=1))
+
+def bench_big_text():
+    lines = ['%d,row %d,some value,%d' % (i, i, i * 7) for i in range(500000)]
+    a = '\n'.join(lines)
+    lines[400000] = 'changed'
+    b = '\n'.join(lines)
+    report('diff multiline string %dMB' % (len(a) >> 20), best_of(lambda: diff(a, b)))
+    held, peak = memory_use(lambda: diff(a, b))
+    report_memory('diff multiline string peak', peak)
+
+def bench_diff_files():
+    n = 2000000
+    # the edits, and what to add to the names of their results
+    for edits, label in (([1500000], ''), ([0, n - 1], ' first+last lines')):
+        lines = ['%d,row %d,some value,%d' % (i, i, i * 7) for i in range(n)]
+        a = '\n'.join(lines)
+        for i in edits:
+            lines[i] = 'changed'
+        b = '\n'.join(lines)
+        del lines
+        paths = []
+        try:
+            for text in (a, b):
+                fd, path = tempfile.mkstemp()
+                paths.append(path)
+                os.write(fd, text.encode('utf-8'))
+                os.close(fd)
+            size = len(a) >> 20
+            del a, b
+            report('diff_files %dMB%s' % (size, label), best_of(lambda: diff_files(*paths)))
+            held, peak = memory_use(lambda: diff_files(*paths))
+            report_memory('diff_files %dMB%s peak' % (size, label), peak)
+        finally:
+            for path in paths:
+                os.remove(path)
+
+def bench_diff_stream():
+    n = 1000000
+    def export(changed):
+        for i in range(n):
+            yield dict(id=i, name='record %d' % i, value=(i % 1000 == 0 and changed))
+    count = lambda: sum(1 for _ in diff_stream(export(False), export(True), key='id'))
+    report('diff_stream n=%d' % n, best_of(count, repeat=1))
+    held, peak = memory_use(count)
+    report_memory('diff_stream n=%d peak' % n, peak)
+
+def bench_ndarray():
+    try:
+        import numpy
+    except ImportError:
+        return
+    a = numpy.random.rand(10000000)
+    b = a.copy()
+    b[::100000] += 1
+    report('diff ndarray n=10000000 100 edits', best_of(lambda: diff(a, b)))
+
+def bench_noisy_floats():
+    import random
+    rand = random.Random(0)
+    a = [rand.random() for _ in range(100000)]
+    b = [x * (1 + rand.uniform(-1e-12, 1e-12)) for x in a]
+    report('diff_seq noisy floats n=100000', best_of(lambda: diff(a, b), repeat=1))
+    report('diff_seq noisy floats rel_tol=1e-9', best_of(lambda: diff(a, b, rel_tol=1e-9), repeat=1))
+
+class Opaque(object):
+    def __init__(self, value):
+        self.value = value
+
+def bench_opaque_objects():
+    n = 20000
+    a = [Opaque(i) for i in range(n)]
+    b = [Opaque(i) for i in range(n)]
+    report('diff_seq opaque objects n=%d' % n, best_of(lambda: diff(a, b)))
+
+def bench_changed_scalars():
+    n = 100000
+    a = list(range(n))
+    b = list(range(n, 2 * n))
+    report('diff_seq all changed ints n=%d' % n, best_of(lambda: diff(a, b)))
+    a = ['a%d' % i for i in range(n)]
+    b = [i for i in range(n)]
+    report('diff_seq all changed types n=%d' % n, best_of(lambda: diff(a, b)))
+
+def bench_wide_dict():
+    n = 100000
+    a = dict(('key%d' % i, i) for i in range(n))
+    b = dict(a)
+    for i in range(0, n, 100):
+        b['key%d' % i] = -i
+    measure('diff_dict wide n=%d 1%% changed' % n, lambda: diff(a, b))
+
+def bench_dict_few_changes():
+    n = 1000000
+    a = dict(('key%d' % i, i) for i in range(n))
+    b = dict(a)
+    for i in range(0, n, n // 20):
+        b['key%d' % i] = -i
+    b['new'] = 1
+    measure('diff_dict n=%d 20 changed' % n, lambda: diff(a, b))
+
+def bench_dict_unshared_values():
+    n = 20000
+    a = dict(('key%d' % i, {'vals': list(range(i % 50)), 'meta': {'id': i, 'tag': 't%d' % i}})
+             for i in range(n))
+    # equal values, but none shared with a
+    b = copy.deepcopy(a)
+    for i in range(0, n, n // 20):
+        b['key%d' % i]['meta']['tag'] = 'changed'
+    measure('diff_dict n=%d unshared values 20 changed' % n, lambda: diff(a, b))
+
+def bench_big_set():
+    n = 200000
+    a = set(range(n))
+    b = set(range(n // 100, n + n // 100))
+    measure('diff_set n=%d' % n, lambda: diff(a, b))
+    measure('diff_set n=%d sort_sets' % n, lambda: diff(a, b, sort_sets=True))
+    measure('diff_set n=%d max_changes=10' % n, lambda: diff(a, b, max_changes=10))
+    measure('diff_set_counts n=%d' % n, lambda: diff_set_counts(a, b))
+
+def bench_hashable_deep():
+    a = deep_nesting(10000, 1)
+    measure('hashable deep nesting depth=10000', lambda: hashable(a))
+
+def bench_stringify_deep():
+    d = diff(deep_nesting(10000, 1), deep_nesting(10000, 2))
+    measure('stringify deep nesting depth=10000', lambda: d.stringify())
+
+def bench_multiline_strings():
+    lines = ['line %d' % i for i in range(20000)]
+    a = '\n'.join(lines)
+    for i in range(0, len(lines), 1000):
+        lines[i] = 'changed'
+    b = '\n'.join(lines)
+    measure('unified_diff_strings 20000 lines', lambda: unified_diff_strings(a, b))
+
+def bench_stats_overhead():
+    a = deep_nesting(1000, 1)
+    b = deep_nesting(1000, 2)
+    report('diff deep nesting depth=1000', best_of(lambda: diff(a, b)))
+    report('diff deep nesting depth=1000 with stats',
+           best_of(lambda: diff(a, b, stats=DiffStats())))
+
+def bench_serialize():
+    n = 20000
+    a = dict(('doc%d' % i, dict(id=i, name='record %d' % i, tags=['x', i])) for i in range(n))
+    b = dict(('doc%d' % i, dict(id=i, name='record %d' % i, tags=['y', i])) for i in range(n))
+    d = diff(a, b)
+    encoded = d.to_bytes()
+    pickled = pickle.dumps(d)
+    text = d.stringify()
+    report_size('serialized diff n=%d to_bytes' % n, len(encoded))
+    report_size('serialized diff n=%d pickle' % n, len(pickled))
+    report_size('serialized diff n=%d text' % n, len(text.encode('utf-8')))
+    report('serialize diff n=%d to_bytes' % n, best_of(d.to_bytes))
+    report('serialize diff n=%d pickle' % n, best_of(lambda: pickle.dumps(d)))
+    report('serialize diff n=%d stringify' % n, best_of(d.stringify))
+    report('deserialize+str n=%d from_bytes' % n, best_of(lambda: str(DataDiff.from_bytes(encoded))))
+    report('deserialize+str n=%d pickle' % n, best_of(lambda: str(pickle.loads(pickled))))
+    report('deserialize one item n=%d from_bytes' % n,
+           best_of(lambda: str(DataDiff.from_bytes(encoded).diffs[0][1][0])))
+    report('deserialize one item n=%d pickle' % n,
+           best_of(lambda: str(pickle.loads(pickled).diffs[0][1][0])))
+
+def bench_patch():
+    for n in (10000, 100000):
+        a = dict(('service%d' % i, dict(host='h%d' % i, ports=[80, 443, i], enabled=True))
+                 for i in range(n))
+        b = dict(a)
+        for i in range(0, n, n // 20):
+            b['service%d' % i] = dict(a['service%d' % i], ports=[80, i])
+        d = diff(a, b, context=0)
+        report_size('patch delta n=%d 20 changed' % n, len(d.to_bytes()))
+        report('patch n=%d 20 changed' % n, best_of(lambda: patch(a, d)))
+
+def snapshot(n):
+    return dict(('doc%d' % i, dict(id=i, tags=['x', 'y', i], body=records(5)))
+                for i in range(n))
+
+def bench_digest_index():
+    n = 20000
+    a = snapshot(n)
+    # a separately built snapshot, so nothing is shared with a, as when loaded from disk
+    b = snapshot(n)
+    for i in range(0, n, n // 20):
+        b['doc%d' % i]['tags'][0] = 'changed'
+    index_a = DigestIndex(a)
+    index_b = DigestIndex(b)
+    measure('digest index build n=%d' % n, lambda: DigestIndex(b), repeat=1)
+    report('diff snapshots n=%d 20 changed' % n, best_of(lambda: diff(a, b), repeat=1))
+    report('diff snapshots n=%d 20 changed index' % n,
+           best_of(lambda: diff(a, b, index=(index_a, index_b))))
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        report('digest index save n=%d' % n, best_of(lambda: index_b.save(path)))
+        report_size('digest index file n=%d' % n, os.path.getsize(path))
+        report('digest index load n=%d' % n, best_of(lambda: DigestIndex.load(path)))
+    finally:
+        os.remove(path)
+
+def bench_dict_memory():
+    n = 200000
+    a = dict(('key%d' % i, i) for i in range(n))
+    b = dict(('key%d' % i, -i) for i in range(n))
+    held, peak = memory_use(lambda: diff(a, b))
+    report_memory('diff_dict held n=%d all changed' % n, held)
+    report_memory('diff_dict peak n=%d all changed' % n, peak)
+
+def bench_seq_memory():
+    a, b = long_list_few_edits(1000000, edits=10)
+    held, peak = memory_use(lambda: diff(a, b, matcher='myers'))
+    report_memory('diff_seq held n=1000000 10 edits', held)
+    report_memory('diff_seq peak n=1000000 10 edits', peak)
+
+
+def compare(baseline, tolerance):
+    """
+    Report timings, peak memory and sizes that grew by more than 'tolerance' (a fraction)
+    since 'baseline'; returns whether there were any
+    """
+    regressed = False
+    for name, result in sorted(results.items()):
+        # small absolute changes are ignored as noise
+        for measurement, unit, noise in (('seconds', 's', 0.01), ('peak_mb', 'MB', 1),
+                                         ('size_kb', 'KB', 1)):
+            before = baseline.get(name, {}).get(measurement)
+            after = result.get(measurement)
+            if before is None or after is None:
+                continue
+            if after > before * (1 + tolerance) and after - before > noise:
+                sys.stdout.write('REGRESSION %-40s %9.4f%s -> %9.4f%s\n'
+                                 % (name, before, unit, after, unit))
+                regressed = True
+    return regressed
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark name words]')
+    parser.add_option('--save', help='write the results to this JSON file')
+    parser.add_option('--compare', help='check the timings against this JSON file')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='slowdown allowed by --compare, as a fraction [%default]')
+    options, words = parser.parse_args(argv)
+    for name, fn in sorted(globals().items()):
+        if name.startswith('bench_') and (not words or any(w in name for w in words)):
+            fn()
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'results': results},
+                      f, indent=1, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(baseline, options.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -18,6 +18,15 @@ import logging
 from difflib import SequenceMatcher, unified_diff
 import sys
 import os
+import time
+import hashlib
+import heapq
+import itertools
+import math
+import mmap
+import operator
+import pickle
+import re
 try:
     from numbers import Number
 except ImportError:
@@ -40,45 +49,1170 @@ For each type, we need:
 class NotHashable(TypeError): pass
 class NotSequence(TypeError): pass
 class DiffTypeError(TypeError): pass
+class DiffTypesDiffer(DiffTypeError):
+    # the message, with reprs of whole values, is only built if it's shown
+    def __init__(self, a, b, fromfile='a', tofile='b'):
+        DiffTypeError.__init__(self, a, b, fromfile, tofile)
+    def __str__(self):
+        a, b, fromfile, tofile = self.args
+        return 'Types differ: %s=%s %s=%s  Values of a and b are: %r, %r' % (fromfile, tofile, type(a), type(b), a, b)
+class PatchError(ValueError): pass
 class DiffNotImplementedForType(DiffTypeError):
     def __init__(self, attempted_type):
         self.attempted_type = attempted_type
     def __str__(self):
         return "diff() not implemented for %s" % self.attempted_type
 
+# strings this long (in total) are diffed by unified_diff_large
+LARGE_TEXT_SIZE = 1024 * 1024
+
 def unified_diff_strings(a, b, fromfile='', tofile='', fromfiledate='', tofiledate='', context=3):
     """
     Wrapper around difflib.unified_diff that accepts 'a' and 'b' as multi-line strings
     and returns a multi-line string, instead of lists of strings.
     """
+    if len(a) + len(b) >= LARGE_TEXT_SIZE:
+        return '\n'.join(unified_diff_large(a, b, fromfile, tofile, fromfiledate, tofiledate, context))
     return '\n'.join(unified_diff(a.split('\n'), b.split('\n'),
                                   fromfile, tofile, fromfiledate, tofiledate, context,
                                   lineterm=''))
 
-def diff(a, b, context=3, depth=0, fromfile='a', tofile='b'):
+def unified_diff_large(a, b, fromfile='', tofile='', fromfiledate='', tofiledate='', context=3,
+                       encoding='utf-8'):
+    """
+    Same lines as difflib.unified_diff(a.split('\\n'), b.split('\\n'), ..., lineterm=''),
+    without splitting up all of a and b.  Runs of lines they have in common are
+    skipped by comparing blocks of them, and only the lines around each difference
+    are split, a window at a time, with lines swapped for integer ids to match up.
+
+    a and b can also be bytes, or anything that slices into bytes like an mmap, in
+    which case the lines shown are decoded with 'encoding'.
+    """
+    newline = '\n' if isinstance(a, str) else b'\n'
+    def decode(lines):
+        if newline == '\n':
+            return lines
+        return [line.decode(encoding, 'replace') for line in lines]
+
+    # opcodes over the lines of a and b, and the text of just the lines they show:
+    # the differing ones, and those next to them that can be context
+    codes = []
+    lines_a = {}
+    lines_b = {}
+    pos_a = pos_b = 0
+    line = line_b = 0
+    ids = {}
+    while True:
+        # skip the lines that are the same
+        same = _common_prefix_length(a, b, pos_a, pos_b)
+        if pos_a + same == len(a) and pos_b + same == len(b):
+            stop = len(a)
+        else:
+            stop = a.rfind(newline, pos_a, pos_a + same)
+        if stop >= pos_a:
+            count = _count(a, newline, pos_a, stop) + 1
+            first, last = _edge_lines(a, newline, pos_a, stop, context)
+            lines_a.update(zip(range(line, line + count), decode(first)))
+            lines_a.update(zip(range(line + count - len(last), line + count), decode(last)))
+            codes.append(('equal', line, line + count, line_b, line_b + count))
+            line += count
+            line_b += count
+            if stop == len(a):
+                break
+            pos_b += stop + 1 - pos_a
+            pos_a = stop + 1
+
+        # diff a window of lines from here, growing it until their
+        # differences end inside it, or it takes in the rest of a and b
+        size = 64
+        while True:
+            end_a, rest_a = _line_window(a, newline, pos_a, size)
+            end_b, rest_b = _line_window(b, newline, pos_b, size)
+            window_a = a[pos_a:end_a if rest_a else end_a - 1].split(newline)
+            window_b = b[pos_b:end_b if rest_b else end_b - 1].split(newline)
+            opcodes = difflib_opcodes([ids.setdefault(l, len(ids)) for l in window_a],
+                                      [ids.setdefault(l, len(ids)) for l in window_b])
+            if rest_a and rest_b:
+                cut_a, cut_b = len(window_a), len(window_b)
+                break
+            # the window ends past its last differences if it ends
+            # with lines in common; those are skipped next time round
+            tag, cut_a, _, cut_b, _ = opcodes[-1]
+            if tag == 'equal' and (cut_a or cut_b):
+                opcodes = opcodes[:-1]
+                break
+            size *= 2
+        codes.extend((tag, line + i1, line + i2, line_b + j1, line_b + j2)
+                     for tag, i1, i2, j1, j2 in opcodes)
+        lines_a.update(zip(range(line, line + cut_a), decode(window_a[:cut_a])))
+        lines_b.update(zip(range(line_b, line_b + cut_b), decode(window_b[:cut_b])))
+        if rest_a and rest_b and cut_a == len(window_a):
+            break
+        pos_a += sum(len(l) for l in window_a[:cut_a]) + cut_a
+        pos_b += sum(len(l) for l in window_b[:cut_b]) + cut_b
+        line += cut_a
+        line_b += cut_b
+        ids.clear()
+
+    # equal runs next to each other are one run, as for difflib
+    merged = []
+    for code in codes:
+        if code[1] == code[2] and code[3] == code[4]:
+            continue
+        if merged and code[0] == merged[-1][0] == 'equal':
+            _, i1, _, j1, _ = merged.pop()
+            code = ('equal', i1, code[2], j1, code[4])
+        merged.append(code)
+
+    started = False
+    for group in group_opcodes(merged, context):
+        if not started:
+            started = True
+            fromdate = '\t%s' % fromfiledate if fromfiledate else ''
+            todate = '\t%s' % tofiledate if tofiledate else ''
+            yield '--- %s%s' % (fromfile, fromdate)
+            yield '+++ %s%s' % (tofile, todate)
+        first, last = group[0], group[-1]
+        yield '@@ -%s +%s @@' % (_format_range_unified(first[1], last[2]),
+                                 _format_range_unified(first[3], last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for i in range(i1, i2):
+                    yield ' ' + lines_a[i]
+                continue
+            if tag in ('replace', 'delete'):
+                for i in range(i1, i2):
+                    yield '-' + lines_a[i]
+            if tag in ('replace', 'insert'):
+                for j in range(j1, j2):
+                    yield '+' + lines_b[j]
+
+def diff_files(path_a, path_b, context=3, encoding='utf-8'):
+    """
+    Like unified_diff_strings() of the contents of two text files, with 'fromfile'
+    and 'tofile' set to their paths.  The files are memory-mapped rather than read in,
+    so only the lines around their differences are ever loaded.
+    """
+    with open(path_a, 'rb') as file_a:
+        with open(path_b, 'rb') as file_b:
+            a = _map_file(file_a)
+            b = _map_file(file_b)
+            try:
+                return '\n'.join(unified_diff_large(a, b, path_a, path_b, context=context,
+                                                    encoding=encoding))
+            finally:
+                for mapped in (a, b):
+                    if isinstance(mapped, mmap.mmap):
+                        mapped.close()
+
+def _map_file(fileobj):
+    # empty files can't be mapped
+    if os.fstat(fileobj.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _format_range_unified(start, stop):
+    # as in difflib
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '%d' % beginning
+    if not length:
+        beginning -= 1
+    return '%d,%d' % (beginning, length)
+
+def _count(s, sub, start, stop, block=65536):
+    """
+    s.count(sub, start, stop), a block at a time, for sequences like mmaps that have
+    no count()
+    """
+    count = 0
+    for i in range(start, stop, block):
+        count += s[i:min(i+block, stop)].count(sub)
+    return count
+
+def _common_prefix_length(a, b, start_a=0, start_b=0, block=65536):
+    """
+    Length of the common prefix of sequences a[start_a:] and b[start_b:], found by
+    comparing slices
+    """
+    n = min(len(a) - start_a, len(b) - start_b)
+    length = 0
+    while length < n and (a[start_a+length:start_a+length+block]
+                          == b[start_b+length:start_b+length+block]):
+        length += block
+    if length >= n:
+        return n
+    # the first difference is in the next block
+    lo, hi = length, min(length + block, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[start_a+length:start_a+mid] == b[start_b+length:start_b+mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _line_window(s, newline, start, count):
+    """
+    The offset just past 'count' lines of s from start, and whether that takes in
+    the rest of s
+    """
+    end = start
+    for _ in range(count):
+        end = s.find(newline, end)
+        if end == -1:
+            return len(s), True
+        end += 1
+    return end, False
+
+def _edge_lines(s, newline, start, stop, count):
+    """
+    The first and the last 'count' lines of s[start:stop], without splitting the rest
+    """
+    end = start
+    for _ in range(count):
+        end = s.find(newline, end, stop)
+        if end == -1:
+            end = stop + 1
+            break
+        end += 1
+    first = s[start:min(end - 1, stop)].split(newline) if count else []
+    begin = stop
+    for _ in range(count):
+        begin = s.rfind(newline, start, begin)
+        if begin == -1:
+            begin = start - 1
+            break
+    last = s[begin + 1:stop].split(newline) if count else []
+    return first, last
+
+def group_opcodes(codes, n=3):
+    """
+    Same as difflib.SequenceMatcher.get_grouped_opcodes, but for any list of
+    opcodes, so that every sequence matcher produces the same hunks
+    """
+    codes = list(codes)
+    if not codes:
+        codes = [("equal", 0, 1, 0, 1)]
+    # Fixup leading and trailing groups if they show no changes.
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2-n), i2, max(j1, j2-n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1+n), j1, min(j2, j1+n)
+
+    nn = n + n
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # End the current group and start a new one whenever
+        # there is a large range with no changes.
+        if tag == 'equal' and i2-i1 > nn:
+            group.append((tag, i1, min(i2, i1+n), j1, min(j2, j1+n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2-n), max(j1, j2-n)
+        group.append((tag, i1, i2, j1 ,j2))
+    if group and not (len(group)==1 and group[0][0] == 'equal'):
+        yield group
+
+def opcodes_from_blocks(blocks, n, m):
+    """
+    Turn (i, j, size) matching blocks into opcodes, the way
+    difflib.SequenceMatcher.get_opcodes does
+    """
+    i = j = 0
+    answer = []
+    for ai, bj, size in list(blocks) + [(n, m, 0)]:
+        tag = ''
+        if i < ai and j < bj:
+            tag = 'replace'
+        elif i < ai:
+            tag = 'delete'
+        elif j < bj:
+            tag = 'insert'
+        if tag:
+            answer.append((tag, i, ai, j, bj))
+        i, j = ai+size, bj+size
+        if size:
+            answer.append(('equal', ai, i, bj, j))
+    return answer
+
+def difflib_opcodes(a, b):
+    return SequenceMatcher(a=a, b=b).get_opcodes()
+
+def myers_opcodes(a, b):
+    """
+    Opcodes for a minimal edit script, using Myers' O(ND) algorithm.
+
+    Fast when the sequences are long but differ in few places, and unlike
+    SequenceMatcher it has no "autojunk" heuristic for long sequences.  Its time and
+    memory grow with the square of the number of differences though, so past
+    _MYERS_MAX_COST of them, the rest is matched by SequenceMatcher instead.
+    """
+    # compare small ints instead of the elements themselves
+    ids = {}
+    a = [ids.setdefault(_, len(ids)) for _ in a]
+    b = [ids.setdefault(_, len(ids)) for _ in b]
+    n, m = len(a), len(b)
+
+    prefix = 0
+    while prefix < n and prefix < m and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n-prefix and suffix < m-prefix and a[n-suffix-1] == b[m-suffix-1]:
+        suffix += 1
+
+    blocks = []
+    if prefix:
+        blocks.append((0, 0, prefix))
+    middle = _myers_blocks(a, b, prefix, n-suffix, prefix, m-suffix, _MYERS_MAX_COST)
+    if middle is None:
+        matcher = SequenceMatcher(a=a[prefix:n-suffix], b=b[prefix:m-suffix])
+        middle = [(prefix+i, prefix+j, size)
+                  for i, j, size in matcher.get_matching_blocks() if size]
+    blocks.extend(middle)
+    if suffix:
+        blocks.append((n-suffix, m-suffix, suffix))
+    return opcodes_from_blocks(blocks, n, m)
+
+# the most differences myers_opcodes finds an edit script with, before it gives up
+_MYERS_MAX_COST = 1000
+
+def _myers_blocks(a, b, a_lo, a_hi, b_lo, b_hi, max_cost):
+    """
+    The matching blocks of a minimal edit script, or None if it takes more than
+    max_cost differences
+    """
+    N = a_hi - a_lo
+    M = b_hi - b_lo
+    if not N or not M:
+        return []
+    max_d = N + M
+    offset = max_d + 1
+    v = [0] * (2*max_d + 3)
+    # trace[d] holds v[k-1..k+1] for k in -d..d, as it was before step d
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(v[offset-d-1:offset+d+2])
+        for k in range(-d, d+1, 2):
+            if k == -d or (k != d and v[offset+k-1] < v[offset+k+1]):
+                x = v[offset+k+1]
+            else:
+                x = v[offset+k-1] + 1
+            y = x - k
+            while x < N and y < M and a[a_lo+x] == b[b_lo+y]:
+                x += 1
+                y += 1
+            v[offset+k] = x
+            if x >= N and y >= M:
+                break
+        else:
+            if d >= max_cost:
+                return None
+            continue
+        break
+
+    # walk the trace backwards, collecting the diagonals (matches)
+    blocks = []
+    x, y = N, M
+    for d in range(len(trace)-1, -1, -1):
+        prev_v = trace[d]
+        k = x - y
+        if k == -d or (k != d and prev_v[k-1+d+1] < prev_v[k+1+d+1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = prev_v[prev_k+d+1]
+        prev_y = prev_x - prev_k
+        if d == 0:
+            prev_x = prev_y = 0
+        size = min(x - prev_x, y - prev_y)
+        if size > 0:
+            blocks.append((a_lo+x-size, b_lo+y-size, size))
+        x, y = prev_x, prev_y
+    blocks.reverse()
+    return blocks
+
+SEQUENCE_MATCHERS = {
+    'difflib': difflib_opcodes,
+    'myers': myers_opcodes,
+}
+
+def diff(a, b, context=3, depth=0, fromfile='a', tofile='b', matcher='difflib',
+         max_changes=None, max_time=None, key=None, workers=None, rel_tol=0, abs_tol=0,
+         stats=None, sort_sets=False, index=None, strict=False, _run=None):
+    """
+    'matcher' picks how sequences get aligned: 'difflib' (SequenceMatcher),
+    'myers', or any function taking two lists and returning opcodes.  'myers'
+    finds minimal diffs, in time and memory that grow with the square of the number
+    of differences; past 1000 of them, it falls back to SequenceMatcher for the
+    rest, so that e.g. two long unrelated lists don't take minutes.
+
+    'key' matches up the items of sequences by an identity, instead of by their
+    whole value.  It is a function of an item, or the name of a field (as in
+    item[key]) of dict-like items.  Items with the same key get a nested diff, if
+    they differ, even if they moved (they then also show as deleted where they
+    were).  Sequences whose items don't all have a key are diffed as usual.
+
+    To bound the cost of diffing big, very different data, 'max_changes' and
+    'max_time' (in seconds) stop the diff from growing once either is used up.
+    The diff is then marked as truncated wherever it stopped.
+
+    'workers' diffs the values of a top-level dict in parallel: either a number of
+    processes, or a concurrent.futures executor to use.  The values (and their
+    diffs) must be picklable for processes.  If 'key' or 'matcher' can't be pickled,
+    e.g. lambdas, a process pool isn't used and the diff runs serially.  It has no
+    effect with 'max_changes', which can't be shared between processes.
+
+    Numbers (ints and floats) that are equal within 'rel_tol' or 'abs_tol', as in
+    math.isclose, are treated as equal.
+
+    'stats' takes a DiffStats, to record where the time went.  With 'workers', the
+    workers' times are added in, so they can add up to more than the time taken.
+
+    'sort_sets' shows the items of set diffs in sorted order (numbers, then strings,
+    then other items by hash), so that they render the same every time.
+
+    'index' takes DigestIndexes of a and b, as a pair, so that dict values and
+    sequence items whose digests match are skipped without being walked.  They
+    must have been built from a and b as they are now.
+
+    'strict' tells apart values that are == but of different types, like 1 and True,
+    [1] and [1.0], or {} and OrderedDict(), so that patch() rebuilds them exactly.
+    """
+    if _run is None:
+        _run = _DiffRun(matcher, max_changes, max_time, key, rel_tol, abs_tol, stats,
+                        sort_sets, index, strict)
+        if index is not None:
+            _run.index_pair(a, b, index[0].root, index[1].root)
+        with _run.timed('diff'):
+            if (workers is not None and max_changes is None and index is None
+                    and type(a) == dict == type(b)):
+                with _run.timed('parallel'):
+                    _diff_values_parallel(a, b, context, depth, _run, workers)
+            steps, seq_type = _diff_steps(a, b, context, depth, fromfile, tofile, _run)
+            return _drive(steps, seq_type, _run)
+    steps, seq_type = _diff_steps(a, b, context, depth, fromfile, tofile, _run)
+    return _drive(steps, seq_type, _run)
+
+def _diff_steps(a, b, context, depth, fromfile, tofile, run):
+    """
+    Pick how to diff a and b.  Returns a generator that does the diffing (see
+    _drive), and the type to blame if it fails because a and b aren't sequences
+    """
     if type(a) != type(b):
-        raise DiffTypeError('Types differ: %s=%s %s=%s  Values of a and b are: %r, %r' % (fromfile, tofile, type(a), type(b), a, b))
-    if type(a) == str:
-        # special cases
-        if '\n' in a or '\n' in b:
-            return unified_diff_strings(a, b, fromfile=fromfile, tofile=tofile, context=context)
+        raise DiffTypesDiffer(a, b, fromfile, tofile)
+    if run.stats is not None:
+        run.stats.count_node(type(a), depth)
+    handler = _handler_for(type(a))
+    if handler is None:
+        raise DiffNotImplementedForType(type(a))
+    return handler(a, b, context, depth, fromfile, tofile, run)
+
+def register_diff(cls, handler):
+    """
+    Make diff() use handler(a, b, context, depth, fromfile, tofile, _run) for
+    instances of cls and its subclasses, e.g. for dataclasses, namedtuples or ORM
+    rows.  It should return a DataDiff, or raise DiffTypeError if it can't diff a and
+    b.  To diff values inside a and b, it can call diff(..., _run=_run).
+    """
+    def steps(a, b, context, depth, fromfile, tofile, run):
+        return _done(handler(a, b, context, depth, fromfile, tofile, run)), None
+    _DIFF_HANDLERS[cls] = steps
+    _handler_cache.clear()
+
+def _handler_for(cls):
+    """
+    How to diff instances of cls (see _diff_steps), or None if they can't be
+    """
+    try:
+        return _handler_cache[cls]
+    except KeyError:
+        pass
+    for base in cls.__mro__:
+        handler = _DIFF_HANDLERS.get(base)
+        if handler is not None:
+            break
+    else:
+        if _is_ndarray_type(cls):
+            handler = _ndarray_steps
+        elif hasattr(cls, 'intersection') and hasattr(cls, 'difference'):
+            handler = _set_steps
+        elif hasattr(cls, '__len__') and (hasattr(cls, '__iter__') or hasattr(cls, '__getitem__')):
+            # not e.g. numpy scalars, which have __getitem__ but aren't sequences
+            handler = _seq_steps
+    _handler_cache[cls] = handler
+    return handler
+
+def _str_steps(a, b, context, depth, fromfile, tofile, run):
+    if '\n' in a or '\n' in b:
+        return _done(unified_diff_strings(a, b, fromfile=fromfile, tofile=tofile, context=context)), None
+    # even though technically it is a sequence,
+    # we don't want to diff char-by-char
+    raise DiffNotImplementedForType(str)
+
+def _dict_steps(a, b, context, depth, fromfile, tofile, run):
+    return _diff_dict_steps(a, b, context, depth, fromfile, tofile, run), None
+
+def _set_steps(a, b, context, depth, fromfile, tofile, run):
+    return _done(_diff_set(a, b, context, depth, fromfile, tofile, run)), None
+
+def _seq_steps(a, b, context, depth, fromfile, tofile, run):
+    return _diff_seq_steps(a, b, context, depth, fromfile, tofile, run), type(a)
+
+def _ndarray_steps(a, b, context, depth, fromfile, tofile, run):
+    return _done(diff_ndarray(a, b, context, depth, fromfile, tofile,
+                              rtol=run.rel_tol, atol=run.abs_tol, _run=run)), None
+
+# type -> function returning a diff generator and the type to blame, as _diff_steps
+_DIFF_HANDLERS = {
+    str: _str_steps,
+    dict: _dict_steps,
+    set: _set_steps,
+    frozenset: _set_steps,
+    list: _seq_steps,
+    tuple: _seq_steps,
+}
+# concrete type -> its handler from _DIFF_HANDLERS or duck typing, or None
+_handler_cache = {}
+
+def _done(result):
+    # a diff generator with no nested diffs to ask for
+    return result
+    yield
+
+def _drive(steps, seq_type, run):
+    """
+    Run a diff generator, and the generators of all the nested diffs it needs.
+
+    Diff generators yield (a, b, context, depth) whenever they need a nested diff,
+    and get sent its result, or thrown its exception.  They're kept on an explicit
+    stack instead of recursing, so any depth of nesting can be diffed.
+    """
+    stack = [(steps, seq_type)]
+    result = error = None
+    while True:
+        steps, seq_type = stack[-1]
+        try:
+            if error is None:
+                request = steps.send(result)
+            else:
+                request = steps.throw(error)
+        except StopIteration as e:
+            result, error = e.value, None
+        except Exception as e:
+            result, error = None, e
+            if seq_type is not None and not isinstance(e, NotHashable):
+                # like try_diff_seq
+                log.debug('tried SequenceMatcher but got error', exc_info=True)
+                run.slow_path('sequence diff failed')
+                error = DiffNotImplementedForType(seq_type)
         else:
-            # even though technically it is a sequence,
-            # we don't want to diff char-by-char
-            raise DiffNotImplementedForType(str)
-    if type(a) == dict:
-        return diff_dict(a, b, context, depth, fromfile=fromfile, tofile=tofile)
-    if hasattr(a, 'intersection') and hasattr(a, 'difference'):
-        return diff_set(a, b, context, depth, fromfile=fromfile, tofile=tofile)
+            a, b, context, depth = request
+            result = error = None
+            done = run.done.get((id(a), id(b)))
+            if done is not None:
+                result, error = done
+                continue
+            try:
+                stack.append(_diff_steps(a, b, context, depth, 'a', 'b', run))
+            except Exception as e:
+                error = e
+            continue
+        stack.pop()
+        if not stack:
+            if error is not None:
+                raise error
+            return result
+
+def _diff_values_parallel(a, b, context, depth, run, workers):
+    """
+    Diff the values that a and b (dicts) have under the same keys, in chunks spread
+    over 'workers', and keep the results in run.done for _drive to pick up
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if isinstance(workers, (int, ProcessPoolExecutor)):
+        # processes need the options pickled; if they can't be, diff serially
+        try:
+            pickle.dumps((run.key, run.matcher))
+        except Exception:
+            run.slow_path('options not picklable')
+            return
+    pairs = []
+    for key, a_val in a.items():
+        if key in b:
+            b_val = b[key]
+            # only ship changed values, as _diff_dict_steps only diffs those
+            if (a_val is not b_val and not _compare_directly(a_val, b_val)
+                    and not run.same(a_val, b_val)):
+                pairs.append((a_val, b_val))
+    if not pairs:
+        return
+    executor = workers
+    if isinstance(workers, int):
+        executor = ProcessPoolExecutor(max_workers=workers)
+    max_time = None
+    if run.deadline is not None:
+        max_time = run.deadline - time.time()
+    # a few chunks per worker, to even out their load
+    chunks = 4 * (workers if isinstance(workers, int) else 8)
+    chunk_size = -(-len(pairs) // chunks)
     try:
-        return try_diff_seq(a, b, context, depth, fromfile=fromfile, tofile=tofile)
-    except NotSequence:
-        raise DiffNotImplementedForType(type(a))
+        futures = []
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start:start+chunk_size]
+            futures.append(executor.submit(_diff_pairs, chunk, context, depth+1,
+                                           run.matcher, max_time, run.key,
+                                           run.rel_tol, run.abs_tol, run.sort_sets, run.strict,
+                                           run.stats is not None))
+        for start, future in zip(range(0, len(pairs), chunk_size), futures):
+            results, stats = future.result()
+            for (a_val, b_val), done in zip(pairs[start:start+chunk_size], results):
+                run.done[id(a_val), id(b_val)] = done
+            if stats is not None:
+                run.stats.merge(stats)
+    finally:
+        if executor is not workers:
+            executor.shutdown()
+
+def _diff_pairs(pairs, context, depth, matcher, max_time, key, rel_tol, abs_tol, sort_sets,
+                strict, keep_stats):
+    # runs in a worker: (result, error) for each pair, and the DiffStats if kept
+    stats = DiffStats() if keep_stats else None
+    run = _DiffRun(matcher, max_time=max_time, key=key, rel_tol=rel_tol, abs_tol=abs_tol,
+                   stats=stats, sort_sets=sort_sets, strict=strict)
+    results = []
+    for a, b in pairs:
+        try:
+            results.append((diff(a, b, context, depth, _run=run), None))
+        except DiffTypeError as e:
+            results.append((None, e))
+    return results, stats
+
+_LENGTHS_DIFFER = object()
+
+def first_difference(a, b):
+    """
+    Walk dicts, sequences and sets like diff() does, but stop at the first difference.
+
+    Returns the path to it, as a tuple of dict keys and sequence indexes (which is
+    empty if a and b differ at the top), or None if a and b are the same.
+    """
+    stack = [iter([(a, b, ())])]
+    while stack:
+        for a, b, path in stack[-1]:
+            break
+        else:
+            stack.pop()
+            continue
+        if a is _LENGTHS_DIFFER:
+            return path
+        if a is b:
+            continue
+        if _compare_directly(a, b):
+            if a != b:
+                return path
+            continue
+        handler = _handler_for(type(a))
+        if handler is _str_steps:
+            if a != b:
+                return path
+        elif handler is _dict_steps:
+            if len(a) != len(b) or a.keys() != b.keys():
+                for key in a:
+                    if key not in b:
+                        return path + (key,)
+                for key in b:
+                    if key not in a:
+                        return path + (key,)
+            stack.append(_dict_children(a, b, path))
+        elif handler is _set_steps:
+            if a != b:
+                return path
+        elif handler is _seq_steps or handler is _ndarray_steps:
+            if len(a) != len(b):
+                shorter = min(len(a), len(b))
+                stack.append(iter([(_LENGTHS_DIFFER, None, path + (shorter,))]))
+            stack.append(_seq_children(a, b, path))
+        elif a != b:
+            return path
+    return None
+
+def _dict_children(a, b, path):
+    for key in a:
+        yield a[key], b[key], path + (key,)
+
+def _seq_children(a, b, path):
+    for i, (a2, b2) in enumerate(zip(a, b)):
+        yield a2, b2, path + (i,)
+
+def differs(a, b):
+    """
+    Whether a and b differ at all; see first_difference()
+    """
+    return first_difference(a, b) is not None
+
+def patch(a, ddiff):
+    """
+    Apply ddiff, a diff() of a and some b, to a, and return b.
+
+    Sequences, dicts, sets and multi-line strings are rebuilt exactly, from a diff
+    with any context; context=0 makes the smallest diffs to store.  Unchanged parts
+    are copied from a, with their values shared rather than copied, so only the
+    changes get walked.  Diffs truncated by max_changes or max_time raise PatchError,
+    and diffs with rel_tol or abs_tol only give b to within those tolerances.
+    Values of b that are == to a's but of another type, like True for 1, [1.0] for
+    [1] or an OrderedDict for a dict, are only patched in from diffs made with
+    strict=True.  Values that aren't ==, like (1,) for [1], always are.
+    """
+    return _patch(a, ddiff, False)
+
+def unpatch(b, ddiff):
+    """
+    The inverse of patch(): apply ddiff, a diff() of some a and b, backwards to b,
+    and return a
+    """
+    return _patch(b, ddiff, True)
+
+def _patch(source, ddiff, reverse):
+    # nested patches go on an explicit stack instead of recursing, as in _drive()
+    stack = [_patch_steps(source, ddiff, reverse)]
+    result = None
+    while True:
+        try:
+            request = stack[-1].send(result)
+        except StopIteration as e:
+            stack.pop()
+            result = e.value
+            if not stack:
+                return result
+        else:
+            stack.append(_patch_steps(request[0], request[1], reverse))
+            result = None
+
+def _patch_steps(source, ddiff, reverse):
+    """
+    A generator that patches source with ddiff, yielding (item, nested diff) for
+    each nested patch it needs and getting sent its result
+    """
+    if isinstance(ddiff, str):
+        return _done(_patch_text(source, ddiff, reverse))
+    if type(ddiff) != DataDiff:
+        raise PatchError('Not a diff: %r' % (ddiff,))
+    patcher = _PATCHERS.get(_handler_for(type(source)))
+    if patcher is None:
+        raise DiffNotImplementedForType(type(source))
+    return patcher(source, ddiff, reverse)
+
+def _patch_changes(ddiff, reverse):
+    """
+    (op, arg, change) for each op of ddiff, with 'delete' and 'insert' swapped
+    when reversed
+    """
+    for op, arg in zip(ddiff._ops, ddiff._args):
+        if op in (_TRUNCATED, _OTHER):
+            raise PatchError('Cannot patch with a truncated diff')
+        change = _OP_CHANGES[op]
+        if reverse and change in _REVERSED_CHANGES:
+            change = _REVERSED_CHANGES[change]
+        yield op, arg, change
+
+_REVERSED_CHANGES = {'delete': 'insert', 'insert': 'delete'}
+
+def _patch_seq_steps(source, ddiff, reverse):
+    result = []
+    pos = 0
+    for op, arg, change in _patch_changes(ddiff, reverse):
+        if op == _CONTEXT:
+            origin = arg[5 if reverse else 4]
+            if origin is None:
+                raise PatchError('Cannot patch with a diff without hunk positions')
+            result.extend(source[pos:origin])
+            pos = origin
+        elif op == _NESTED:
+            result.append((yield source[pos], arg))
+            pos += 1
+        elif op == _MOVED:
+            # the item of a it was moved from is deleted where it was
+            if reverse:
+                pos += 1
+            else:
+                result.append(arg[0])
+        elif change == 'insert':
+            result.extend(_op_items(op, arg))
+        elif change != 'context_end_container':
+            # items of source, deleted or kept
+            if op in (_DELETE_RANGE, _INSERT_RANGE, _EQUAL_RANGE):
+                count = arg[2] - arg[1]
+            elif op in (_DELETE, _INSERT, _EQUAL):
+                count = len(arg)
+            else:
+                count = 1
+            if change == 'equal':
+                result.extend(source[pos:pos+count])
+            pos += count
+    result.extend(source[pos:])
+    if type(source) == list:
+        return result
+    return type(source)(result)
+
+def _patch_dict_steps(source, ddiff, reverse):
+    result = source.copy()
+    added = []
+    for op, arg, change in _patch_changes(ddiff, reverse):
+        if op == _NESTED_ITEM:
+            key, nested = arg
+            result[key] = yield source[key], nested
+        elif change == 'delete':
+            for key, value in _op_items(op, arg):
+                del result[key]
+        elif change == 'insert':
+            added.extend(_op_items(op, arg))
+        # changed values are deleted then inserted, so they go in after all deletes
+    for key, value in added:
+        result[key] = value
+    return result
+
+def _patch_set_steps(source, ddiff, reverse):
+    result = set(source)
+    added = []
+    for op, arg, change in _patch_changes(ddiff, reverse):
+        if change == 'delete':
+            result.difference_update(_op_items(op, arg))
+        elif change == 'insert':
+            added.extend(_op_items(op, arg))
+    result.update(added)
+    if type(source) == set:
+        return result
+    return type(source)(result)
+    # a patch generator with no nested patches to ask for
+    yield
+
+_PATCHERS = {
+    _seq_steps: _patch_seq_steps,
+    _dict_steps: _patch_dict_steps,
+    _set_steps: _patch_set_steps,
+}
+
+_HUNK_HEADER = re.compile(r'@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+def _patch_text(source, text, reverse):
+    """
+    Apply a unified diff from unified_diff_strings() to the lines of source
+    """
+    if not text:
+        return source
+    lines = text.split('\n')
+    source_lines = source.split('\n')
+    removed, added = ('+', '-') if reverse else ('-', '+')
+    result = []
+    pos = 0
+    # after the --- and +++ lines, each hunk is a header and its lines
+    i = 2
+    while i < len(lines):
+        match = _HUNK_HEADER.match(lines[i])
+        if match is None:
+            raise PatchError('Not a hunk header: %r' % lines[i])
+        i += 1
+        ranges = [int(n) if n is not None else 1 for n in match.groups()]
+        if reverse:
+            ranges = ranges[2:] + ranges[:2]
+        start, source_length, _, target_length = ranges
+        # as in difflib, an empty range starts on the line before
+        if source_length:
+            start -= 1
+        result.extend(source_lines[pos:start])
+        pos = start
+        while source_length or target_length:
+            line = lines[i]
+            i += 1
+            if line[:1] == added:
+                result.append(line[1:])
+                target_length -= 1
+                continue
+            if line[:1] == ' ':
+                result.append(source_lines[pos])
+                target_length -= 1
+            pos += 1
+            source_length -= 1
+    result.extend(source_lines[pos:])
+    return '\n'.join(result)
+
+_STREAM_END = object()
+
+def diff_stream(iter_a, iter_b, key, context=3, matcher='difflib'):
+    """
+    Diff two streams of records, such as two JSON Lines exports, that are sorted by
+    a unique key.  Only one record of each stream is held at a time.
+
+    'key' is a function of a record, or the name of its key field.  Yields
+    ('delete', key, record) for records only in iter_a, ('insert', key, record) for
+    records only in iter_b, and ('changed', key, datadiff) for records in both that
+    differ, as they're found.  Raises ValueError if a stream isn't sorted by key.
+    """
+    if not callable(key):
+        key = operator.itemgetter(key)
+    iter_a = _keyed_records(iter_a, key, 'a')
+    iter_b = _keyed_records(iter_b, key, 'b')
+    key_a, a = next(iter_a, (None, _STREAM_END))
+    key_b, b = next(iter_b, (None, _STREAM_END))
+    while a is not _STREAM_END or b is not _STREAM_END:
+        if b is _STREAM_END or (a is not _STREAM_END and key_a < key_b):
+            yield 'delete', key_a, a
+            key_a, a = next(iter_a, (None, _STREAM_END))
+        elif a is _STREAM_END or key_b < key_a:
+            yield 'insert', key_b, b
+            key_b, b = next(iter_b, (None, _STREAM_END))
+        else:
+            if a != b:
+                try:
+                    ddiff = diff(a, b, context, matcher=matcher)
+                except DiffTypeError:
+                    ddiff = None
+                if ddiff is None:
+                    yield 'delete', key_a, a
+                    yield 'insert', key_b, b
+                else:
+                    yield 'changed', key_a, ddiff
+            key_a, a = next(iter_a, (None, _STREAM_END))
+            key_b, b = next(iter_b, (None, _STREAM_END))
+
+def _keyed_records(records, key, name):
+    previous = _STREAM_END
+    for record in records:
+        record_key = key(record)
+        if previous is not _STREAM_END and not previous < record_key:
+            raise ValueError("Stream %s isn't sorted by unique keys: %r came after %r"
+                             % (name, record_key, previous))
+        previous = record_key
+        yield record_key, record
+
+class _DiffRun(object):
+    """
+    State shared by every level of one top-level diff() call
+    """
+    def __init__(self, matcher='difflib', max_changes=None, max_time=None, key=None,
+                 rel_tol=0, abs_tol=0, stats=None, sort_sets=False, index=None, strict=False):
+        self.hashes = _HashCache(rel_tol, abs_tol, strict)
+        self.rel_tol = rel_tol
+        self.abs_tol = abs_tol
+        if not callable(matcher):
+            try:
+                matcher = SEQUENCE_MATCHERS[matcher]
+            except KeyError:
+                raise ValueError("Unknown sequence matcher %r" % matcher)
+        self.matcher = matcher
+        if key is not None and not callable(key):
+            key = operator.itemgetter(key)
+        self.key = key
+        self.changes_left = max_changes
+        self.deadline = None
+        if max_time is not None:
+            self.deadline = time.time() + max_time
+        self.truncated = False
+        # (id(a), id(b)) -> (result, error) of nested diffs that were done in advance
+        self.done = {}
+        self.stats = stats
+        self.sort_sets = sort_sets
+        self.strict = strict
+        # id(value) -> (value, digest node) of the values of a, and of b, whose
+        # DigestIndex nodes are known
+        self.index_nodes = None if index is None else ({}, {})
+
+    def index_pair(self, a, b, node_a, node_b):
+        """
+        Note the digest nodes of a and b, for when they get diffed
+        """
+        if node_a is not None and node_b is not None:
+            self.index_nodes[0][id(a)] = (a, node_a)
+            self.index_nodes[1][id(b)] = (b, node_b)
+
+    def index_children(self, a, b):
+        """
+        The children of the digest nodes of a and b (see _DigestNode), or Nones
+        """
+        if self.index_nodes is None:
+            return None, None
+        entry_a = self.index_nodes[0].get(id(a))
+        entry_b = self.index_nodes[1].get(id(b))
+        if entry_a is None or entry_b is None:
+            return None, None
+        return entry_a[1].children, entry_b[1].children
+
+    def timed(self, phase):
+        """
+        Context manager adding its time to 'phase' in the stats, if any are kept
+        """
+        if self.stats is None:
+            return _NO_TIMING
+        return self.stats.timed(phase)
+
+    def slow_path(self, name):
+        if self.stats is not None:
+            self.stats.slow_paths[name] = self.stats.slow_paths.get(name, 0) + 1
+
+    def same(self, a, b):
+        """
+        Whether a and b are equal (strictly, if so diffed).  A C-level == settles
+        most values; values nested deeper than it can recurse, and strict diffs,
+        compare fingerprints instead, which are built without recursing.  False
+        where neither can tell, e.g. for nested arrays.
+        """
+        if not self.strict:
+            try:
+                return bool(a == b)
+            except (ValueError, TypeError):
+                return False
+            except RecursionError:
+                pass
+        try:
+            return self.hashes.fingerprint(a) == self.hashes.fingerprint(b)
+        except NotHashable:
+            return False
+
+    def close(self, a, b):
+        """
+        Whether a and b are numbers that are equal within the tolerances, if any
+        """
+        if not self.rel_tol and not self.abs_tol:
+            return False
+        return _close(a, b, self.rel_tol, self.abs_tol)
+
+    def out_of_budget(self):
+        """
+        Whether the diff should stop growing, because max_changes or max_time is used up
+        """
+        if self.truncated:
+            return True
+        if self.changes_left is not None and self.changes_left <= 0:
+            self.truncated = True
+        elif self.deadline is not None and time.time() > self.deadline:
+            self.truncated = True
+        return self.truncated
+
+    def spend(self, changes):
+        if self.changes_left is not None:
+            self.changes_left -= changes
+
+    def allow(self, count):
+        """
+        How many of 'count' changed items fit in the budget
+        """
+        if self.out_of_budget():
+            return 0
+        if self.changes_left is not None and count > self.changes_left:
+            count = self.changes_left
+            self.truncated = True
+        self.spend(count)
+        return count
+
+class DiffStats(object):
+    """
+    Collects where the time goes, when passed as diff(..., stats=) and to
+    DataDiff.stringify() or write_to().
+
+    'times' maps phases (diff, fingerprint, match, dict sort, render, ...) to
+    seconds, 'nodes' maps type names to how many values of that type were diffed,
+    'max_depth' is the deepest nesting diffed, 'chars_rendered' counts the text
+    rendered, and 'slow_paths' counts fallbacks like nested diffs that failed.
+    """
+    def __init__(self):
+        self.times = {}
+        self.nodes = {}
+        self.max_depth = 0
+        self.chars_rendered = 0
+        self.slow_paths = {}
+
+    def timed(self, phase):
+        return _Timing(self, phase)
+
+    def count_node(self, cls, depth):
+        name = cls.__name__
+        self.nodes[name] = self.nodes.get(name, 0) + 1
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def merge(self, other):
+        """
+        Add in the stats of another DiffStats, e.g. of a worker process
+        """
+        for mine, theirs in ((self.times, other.times), (self.nodes, other.nodes),
+                             (self.slow_paths, other.slow_paths)):
+            for name, value in theirs.items():
+                mine[name] = mine.get(name, 0) + value
+        self.max_depth = max(self.max_depth, other.max_depth)
+        self.chars_rendered += other.chars_rendered
+
+    def __str__(self):
+        lines = ['%s: %.4fs' % item for item in sorted(self.times.items())]
+        lines.append('nodes: %s' % ', '.join('%s=%d' % item for item in sorted(self.nodes.items())))
+        lines.append('max depth: %d' % self.max_depth)
+        lines.append('chars rendered: %d' % self.chars_rendered)
+        for item in sorted(self.slow_paths.items()):
+            lines.append('slow path %s: %d' % item)
+        return '\n'.join(lines)
+
+class _Timing(object):
+    __slots__ = ('stats', 'phase', 'start')
+
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        times = self.stats.times
+        times[self.phase] = times.get(self.phase, 0) + time.time() - self.start
+
+class _NoTiming(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NO_TIMING = _NoTiming()
+
+# DataDiff op codes
+(_CONTEXT, _CONTEXT_END, _TRUNCATED, _NESTED, _NESTED_ITEM,
+ _DELETE, _INSERT, _EQUAL, _DELETE_ONE, _INSERT_ONE, _EQUAL_ONE,
+ _DELETE_RANGE, _INSERT_RANGE, _EQUAL_RANGE, _OTHER, _MOVED) = range(16)
+
+_MULTI_OPS = {'delete': _DELETE, 'insert': _INSERT, 'equal': _EQUAL}
+_RANGE_OPS = {'delete': _DELETE_RANGE, 'insert': _INSERT_RANGE, 'equal': _EQUAL_RANGE}
+_OP_CHANGES = {
+    _CONTEXT: 'context', _CONTEXT_END: 'context_end_container', _TRUNCATED: 'truncated',
+    _NESTED: 'datadiff', _NESTED_ITEM: 'equal', _MOVED: 'moved',
+    _DELETE: 'delete', _INSERT: 'insert', _EQUAL: 'equal',
+    _DELETE_ONE: 'delete', _INSERT_ONE: 'insert', _EQUAL_ONE: 'equal',
+    _DELETE_RANGE: 'delete', _INSERT_RANGE: 'insert', _EQUAL_RANGE: 'equal',
+}
+_OP_CHARS = {
+    _DELETE: '-', _INSERT: '+', _EQUAL: ' ',
+    _DELETE_ONE: '-', _INSERT_ONE: '+', _EQUAL_ONE: ' ',
+    _DELETE_RANGE: '-', _INSERT_RANGE: '+', _EQUAL_RANGE: ' ',
+}
 
 class DataDiff(object):
-    
+    """
+    Changes are stored compactly, as a bytearray of op codes and a list of each op's
+    argument, where single items aren't wrapped in lists, and runs of items from a
+    sequence are kept as (sequence, start, stop) instead of copied.  The 'diffs'
+    property gives a read-only tuple of (change, items) for them; to change them,
+    assign a new list to it.
+
+    to_bytes() and from_bytes() convert diffs to and from a compact binary form.
+    """
+    __slots__ = ('_ops', '_args', 'datatype', 'fromfile', 'tofile', 'type_start_str', 'type_end_str',
+                 '_encoded')
+
     def __init__(self, datatype, type_start_str=None, type_end_str=None, fromfile='a', tofile='b'):
-        self.diffs = []
+        self._ops = bytearray()
+        self._args = []
         self.datatype = datatype
         self.fromfile = fromfile
         self.tofile = tofile
@@ -91,27 +1225,91 @@ class DataDiff(object):
             self.type_start_str = type_start_str
             self.type_end_str = type_end_str
 
-    def context(self, a_start, a_end, b_start, b_end):
-        self.diffs.append(('context', [a_start, a_end, b_start, b_end]))
+    def _append(self, op, arg):
+        self._ops.append(op)
+        self._args.append(arg)
+
+    @property
+    def diffs(self):
+        # a tuple, so that code changing it in place fails instead of doing nothing
+        return tuple(_op_entry(op, arg) for op, arg in zip(self._ops, self._args))
+
+    @diffs.setter
+    def diffs(self, diffs):
+        self._ops = bytearray()
+        self._args = []
+        for change, items in diffs:
+            if change == 'context':
+                self.context(*items)
+            elif change == 'context_end_container':
+                self.context_end_container()
+            elif change == 'truncated':
+                self.truncated()
+            elif change == 'datadiff':
+                self.nested(items)
+            elif change == 'moved':
+                self.moved(*items)
+            else:
+                self.multi(change, items)
+
+    def context(self, a_start, a_end, b_start, b_end, a_origin=None, b_origin=None):
+        """
+        The start of a hunk of a sequence diff, with the line numbers to show, and
+        the exact indexes of its first items in a and b, for patch()
+        """
+        self._append(_CONTEXT, (a_start, a_end, b_start, b_end, a_origin, b_origin))
 
     def context_end_container(self):
-        self.diffs.append(('context_end_container', []))
+        self._append(_CONTEXT_END, None)
+
+    def truncated(self):
+        self._append(_TRUNCATED, None)
         
     def nested(self, datadiff):
-        self.diffs.append(('datadiff', datadiff))
+        self._append(_NESTED, datadiff)
+
+    def moved(self, item, datadiff):
+        """
+        An item of b that was moved there from elsewhere in a (where it shows as
+        deleted), and datadiff, the diff of it from a's item
+        """
+        self._append(_MOVED, (item, datadiff))
+
+    def nested_dictitem(self, key, datadiff):
+        self._append(_NESTED_ITEM, dictitem((key, datadiff)))
 
     def multi(self, change, items):
-        self.diffs.append((change, items))
+        op = _MULTI_OPS.get(change)
+        if op is None:
+            self._append(_OTHER, (change, items))
+        else:
+            self._append(op, items)
         
     def delete(self, item):
-        return self.multi('delete', [item])
+        self._append(_DELETE_ONE, item)
     
     def insert(self, item):
-        return self.multi('insert', [item])
+        self._append(_INSERT_ONE, item)
     
     def equal(self, item):
-        return self.multi('equal', [item])
+        self._append(_EQUAL_ONE, item)
         
+    def multi_range(self, change, source, start, stop):
+        """
+        Like multi(), with items source[start:stop], but without copying them
+        """
+        if start < stop:
+            self._append(_RANGE_OPS[change], (source, start, stop))
+
+    def delete_range(self, source, start, stop):
+        return self.multi_range('delete', source, start, stop)
+
+    def insert_range(self, source, start, stop):
+        return self.multi_range('insert', source, start, stop)
+
+    def equal_range(self, source, start, stop):
+        return self.multi_range('equal', source, start, stop)
+
     def insert_multi(self, items):
         return self.multi('insert', items)
     
@@ -124,65 +1322,551 @@ class DataDiff(object):
     def __str__(self):
         return self.stringify()
         
-    def stringify(self, depth=0, include_preamble=True):
-        if not self.diffs:
-            return ''
-        output = []
+    def stringify(self, depth=0, include_preamble=True, stats=None):
+        if stats is None:
+            return '\n'.join(self.iter_lines(depth, include_preamble))
+        with stats.timed('render'):
+            text = '\n'.join(self.iter_lines(depth, include_preamble))
+        stats.chars_rendered += len(text)
+        return text
+
+    def write_to(self, fileobj, depth=0, include_preamble=True, stats=None):
+        """
+        Write the same text as stringify() to fileobj, one line at a time
+        """
+        timing = _NO_TIMING if stats is None else stats.timed('render')
+        written = 0
+        with timing:
+            separator = ''
+            for line in self.iter_lines(depth, include_preamble):
+                fileobj.write(separator)
+                fileobj.write(line)
+                written += len(separator) + len(line)
+                separator = '\n'
+        if stats is not None:
+            stats.chars_rendered += written
+
+    def iter_lines(self, depth=0, include_preamble=True):
+        """
+        Generate the lines of stringify() lazily, without building the text of
+        nested diffs first
+        """
+        if not self._ops:
+            return
         if depth == 0 and include_preamble:
-            output.append('--- %s' % self.fromfile)
-            output.append('+++ %s' % self.tofile)
-        output.append(' '*depth + self.type_start_str)
-        for change, items in self.diffs:
-            if change == 'context':
-                context_a = str(items[0])
-                if items[0] != items[1]:
-                    context_a += ',' + str(items[1])
-                context_b = str(items[2])
-                if items[2] != items[3]:
-                    context_b += ',' + str(items[3])
-                output.append(' '*depth + '@@ -%s +%s @@' % (context_a, context_b))
+            yield '--- %s' % self.fromfile
+            yield '+++ %s' % self.tofile
+        # nested diffs go on an explicit stack instead of recursing,
+        # so any depth of nesting can be rendered
+        stack = [self._render_steps(depth)]
+        while stack:
+            for step in stack[-1]:
+                if type(step) == tuple:
+                    nested, nested_args = step
+                    stack.append(nested._render_steps(*nested_args))
+                    break
+                yield step
+            else:
+                stack.pop()
+
+    def _render_steps(self, depth, prefix='', suffix='', strip=False):
+        """
+        Generate this diff's lines, with (nested_diff, args) in place of the lines of
+        each nested diff.  The prefix and suffix go on the first and last line, and
+        with strip, the text gets stripped before that.
+        """
+        if not self._ops:
+            yield prefix + suffix
+            return
+        indent = ' '*depth
+        line = indent + self.type_start_str
+        yield prefix + (line.lstrip() if strip else line)
+        for op, arg in zip(self._ops, self._args):
+            if op == _CONTEXT:
+                context_a = str(arg[0])
+                if arg[0] != arg[1]:
+                    context_a += ',' + str(arg[1])
+                context_b = str(arg[2])
+                if arg[2] != arg[3]:
+                    context_b += ',' + str(arg[3])
+                yield indent + '@@ -%s +%s @@' % (context_a, context_b)
                 continue
-            if change == 'context_end_container':
-                output.append(' '*depth + '@@  @@')
+            if op == _CONTEXT_END:
+                yield indent + '@@  @@'
                 continue
-            elif change == 'datadiff':
-                output.append(' '*depth + items.stringify(depth+1) + ',')
+            if op == _TRUNCATED:
+                yield indent + '@@ diff truncated @@'
                 continue
-            if change == 'delete':
-                ch = '-'
-            elif change == 'insert':
-                ch = '+'
-            elif change == 'equal':
+            elif op == _NESTED:
+                if type(arg) != DataDiff:
+                    # a diff of multi-line strings
+                    yield indent + ' %r,' % (arg,)
+                    continue
+                yield arg, (depth+1, indent, ',')
+                continue
+            elif op == _MOVED:
+                yield arg[1], (depth+1, indent, ',')
+                continue
+            elif op == _NESTED_ITEM:
                 ch = ' '
+                items = (arg,)
+            elif op == _OTHER:
+                raise Exception('Unknown change type %r' % arg[0])
             else:
-                raise Exception('Unknown change type %r' % change)
+                ch = _OP_CHARS[op]
+                items = _op_items(op, arg)
             for item in items:
-                output.append(' '*depth + "%s%r," % (ch, item))
-        output.append(' '*depth + self.type_end_str)
-        return '\n'.join(output)
-    
+                if type(item) == dictitem and type(item[1]) == DataDiff:
+                    key, val = item
+                    yield val, (depth+1, indent + "%s%r: " % (ch, key), ',', True)
+                else:
+                    yield indent + "%s%r," % (ch, item)
+        line = indent + self.type_end_str
+        yield (line.rstrip() if strip else line) + suffix
+
     def __nonzero__(self):
         return self.__bool__()
     
     def __bool__(self):
-        return bool([d for d in self.diffs if d[0] != 'equal'])
+        for op, arg in zip(self._ops, self._args):
+            if op in (_CONTEXT, _CONTEXT_END, _EQUAL, _EQUAL_ONE, _EQUAL_RANGE):
+                continue
+            if op in (_DELETE, _INSERT) and not len(arg):
+                continue
+            return True
+        return False
 
-def hashable(s):
-    try:
-        # convert top-level container
-        if type(s) == list:
-            ret = tuple(s)
-        elif type(s) == dict:
-            ret = frozenset(hashable(_) for _ in s.items())
-        elif type(s) == set:
-            ret = frozenset(s)
+    def __getstate__(self):
+        # runs of items get pickled as copies, rather than with their whole sequence
+        ops = bytearray()
+        args = []
+        for op, arg in zip(self._ops, self._args):
+            if op in (_DELETE_RANGE, _INSERT_RANGE, _EQUAL_RANGE):
+                arg = list(_op_items(op, arg))
+                op = _MULTI_OPS[_OP_CHANGES[op]]
+            ops.append(op)
+            args.append(arg)
+        return (ops, args, self.datatype, self.fromfile, self.tofile,
+                self.type_start_str, self.type_end_str)
+
+    def __setstate__(self, state):
+        (self._ops, self._args, self.datatype, self.fromfile, self.tofile,
+         self.type_start_str, self.type_end_str) = state
+
+    def to_bytes(self):
+        """
+        This diff as bytes, for from_bytes().  Each distinct value is stored once, in
+        a table at the start, and nested diffs are length-prefixed so they can be
+        skipped over.  Lists, tuples and dicts are stored as the indexes of their
+        items, other values than ints and strs are pickled, and runs of items are
+        stored as copies, as when pickling.
+        """
+        encoder = _Encoder()
+        # nested diffs go on an explicit stack instead of recursing,
+        # so any depth of nesting can be encoded
+        stack = [_encode_steps(self, encoder)]
+        while stack:
+            try:
+                nested = next(stack[-1])
+            except StopIteration:
+                stack.pop()
+            else:
+                stack.append(_encode_steps(nested, encoder))
+        out = bytearray(_BYTES_MAGIC)
+        _write_varint(out, len(encoder.index))
+        out += encoder.table
+        # the chunks were written back to front, see _encode_steps
+        encoder.chunks.reverse()
+        out += b''.join(encoder.chunks)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        The DataDiff that to_bytes() gave 'data'.  It is decoded lazily: each nested
+        diff, and each value in the table, only gets decoded when first used.  Like
+        pickle, this must only be used on trusted data.
+        """
+        data = bytes(data)
+        if not data.startswith(_BYTES_MAGIC):
+            raise ValueError('Not an encoded DataDiff')
+        table = _ValueTable(data, len(_BYTES_MAGIC))
+        return _lazy_datadiff(data, table.end, len(data), table)
+
+    def __getattr__(self, name):
+        # only called for unset slots, i.e. of a lazy diff from from_bytes()
+        if name != '_encoded' and name in DataDiff.__slots__:
+            self._decode()
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def _decode(self):
+        data, pos, end, table = self._encoded
+        header = []
+        for _ in range(6):
+            n, pos = _read_varint(data, pos)
+            header.append(n)
+        self.datatype, self.type_start_str, self.type_end_str, self.fromfile, self.tofile = \
+            [table[i] for i in header[:5]]
+        ops = bytearray()
+        args = []
+        for _ in range(header[5]):
+            op = data[pos]
+            pos += 1
+            if op == _CONTEXT:
+                arg = []
+                for _ in range(6):
+                    n, pos = _read_varint(data, pos)
+                    arg.append(n)
+                arg[4:] = [None if n == 0 else n - 1 for n in arg[4:]]
+                arg = tuple(arg)
+            elif op in (_CONTEXT_END, _TRUNCATED):
+                arg = None
+            elif op == _NESTED:
+                size, pos = _read_varint(data, pos)
+                if size:
+                    arg = _lazy_datadiff(data, pos, pos + size, table)
+                    pos += size
+                else:
+                    n, pos = _read_varint(data, pos)
+                    arg = table[n]
+            elif op == _OTHER:
+                n, pos = _read_varint(data, pos)
+                arg = table[n]
+            elif op == _MOVED:
+                n, pos = _read_varint(data, pos)
+                size, pos = _read_varint(data, pos)
+                arg = (table[n], _lazy_datadiff(data, pos, pos + size, table))
+                pos += size
+            elif op in (_DELETE, _INSERT, _EQUAL):
+                count, pos = _read_varint(data, pos)
+                arg = []
+                for _ in range(count):
+                    item, pos = _read_item(data, pos, table)
+                    arg.append(item)
+            else:
+                arg, pos = _read_item(data, pos, table)
+            ops.append(op)
+            args.append(arg)
+        self._ops = ops
+        self._args = args
+        del self._encoded
+
+def _op_entry(op, arg):
+    """
+    (change, items) for a DataDiff op, as in DataDiff.diffs
+    """
+    if op == _CONTEXT:
+        return 'context', list(arg[:4])
+    if op == _NESTED:
+        return 'datadiff', arg
+    if op == _MOVED:
+        return 'moved', list(arg)
+    if op == _OTHER:
+        return arg
+    if op in (_DELETE, _INSERT, _EQUAL):
+        return _OP_CHANGES[op], arg
+    if op in (_CONTEXT_END, _TRUNCATED):
+        return _OP_CHANGES[op], []
+    return _OP_CHANGES[op], list(_op_items(op, arg))
+
+def _op_items(op, arg):
+    """
+    The items of a delete/insert/equal op
+    """
+    if op in (_DELETE, _INSERT, _EQUAL):
+        return arg
+    if op in (_DELETE_RANGE, _INSERT_RANGE, _EQUAL_RANGE):
+        source, start, stop = arg
+        return (source[i] for i in range(start, stop))
+    return (arg,)
+
+# DataDiff.to_bytes() format: _BYTES_MAGIC, the value table (a varint count, then
+# each value as a _VALUE_* tag and a varint: an int, or the length of the UTF-8 of
+# a str, a pickle, or the varint indexes of a container's items), then the top diff.  A diff is varint value table indexes of
+# its datatype, type_start_str, type_end_str, fromfile and tofile, a varint op count,
+# and its ops: each an op code, then
+#   _CONTEXT: 4 varints, then the 2 origins as varints of 1 more, or 0 for None
+#   _NESTED: the nested diff, prefixed with its varint length, or for a diff of
+#     multi-line strings, 0 and its index
+#   _OTHER: the index of its (change, items)
+#   _MOVED: the index of the item, then its nested diff, prefixed with its varint length
+#   _DELETE, _INSERT, _EQUAL: a varint count, then the items
+#   _NESTED_ITEM, _*_ONE: the item
+# and an item is a varint index*4 of its value, or a dictitem as key index*4+2 then
+# the value's varint index, or, when its value is a nested diff, as key index*4+1
+# then the length-prefixed nested diff.
+_BYTES_MAGIC = b'DDIFF\x01'
+(_VALUE_PICKLE, _VALUE_STR, _VALUE_INT, _VALUE_LIST, _VALUE_TUPLE,
+ _VALUE_DICT) = range(6)
+_VALUE_CONTAINERS = {list: _VALUE_LIST, tuple: _VALUE_TUPLE, dict: _VALUE_DICT}
+_CONTAINER_VALUES = {_VALUE_LIST: list, _VALUE_TUPLE: tuple, _VALUE_DICT: dict}
+_ITEM_VALUE, _ITEM_NESTED, _ITEM_DICTITEM = range(3)
+_STORED_OPS = {_DELETE_RANGE: _DELETE, _INSERT_RANGE: _INSERT, _EQUAL_RANGE: _EQUAL}
+
+def _write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _read_varint(data, pos):
+    byte = data[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+def _read_item(data, pos, table):
+    n, pos = _read_varint(data, pos)
+    tag = n & 3
+    if tag == _ITEM_VALUE:
+        return table[n >> 2], pos
+    if tag == _ITEM_DICTITEM:
+        value, pos = _read_varint(data, pos)
+        return dictitem((table[n >> 2], table[value])), pos
+    size, pos = _read_varint(data, pos)
+    nested = _lazy_datadiff(data, pos, pos + size, table)
+    return dictitem((table[n >> 2], nested)), pos + size
+
+def _lazy_datadiff(data, start, end, table):
+    ddiff = DataDiff.__new__(DataDiff)
+    ddiff._encoded = (data, start, end, table)
+    return ddiff
+
+class _Encoder(object):
+    """
+    The state of DataDiff.to_bytes(): the value table so far, and the chunks of
+    encoded diffs, back to front
+    """
+    def __init__(self):
+        self.index = {}
+        # id() -> (value, index), as a shortcut for values seen before; the value
+        # is kept so its id can't be reused, as by the items of numpy array ranges
+        self.ids = {}
+        self.table = bytearray()
+        self.chunks = []
+        self.size = 0
+
+    def emit(self, chunk):
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+
+    def value(self, value):
+        """
+        The table index of value, adding it if it's new
+        """
+        seen = self.ids.get(id(value))
+        index = self._leaf(value) if seen is None else seen[1]
+        if index is not None:
+            return index
+        # containers are stored as the indexes of their items, so those get added
+        # first; they go on an explicit stack, for any depth of nesting
+        stack = [(value, _fingerprint_children(value), [])]
+        while True:
+            container, children, indexes = stack[-1]
+            for child in children:
+                seen = self.ids.get(id(child))
+                index = self._leaf(child) if seen is None else seen[1]
+                if index is None:
+                    stack.append((child, _fingerprint_children(child), []))
+                    break
+                indexes.append(index)
+            else:
+                stack.pop()
+                index = self._add((type(container), tuple(indexes)),
+                                  _VALUE_CONTAINERS[type(container)], indexes)
+                self.ids[id(container)] = (container, index)
+                if not stack:
+                    return index
+                stack[-1][2].append(index)
+
+    def _leaf(self, value):
+        # the index of value, or None for a list, tuple or dict
+        value_type = type(value)
+        if value_type == str:
+            index = self._add((str, value), _VALUE_STR, value)
+        elif value_type == int:
+            index = self._add((int, value), _VALUE_INT, value)
+        elif value_type in _VALUE_CONTAINERS:
+            return None
         else:
-            ret = s
-        
-        # make it recursive
-        if type(ret) == tuple:
-            ret = tuple(hashable(_) for _ in ret)
-        
+            # equal values of other types can still differ, like 0.0 and -0.0
+            payload = pickle.dumps(value, 2)
+            index = self._add(payload, _VALUE_PICKLE, payload)
+        self.ids[id(value)] = (value, index)
+        return index
+
+    def _add(self, key, tag, value):
+        index = self.index.get(key)
+        if index is not None:
+            return index
+        index = self.index[key] = len(self.index)
+        table = self.table
+        table.append(tag)
+        if tag == _VALUE_INT:
+            _write_varint(table, value << 1 if value >= 0 else (-value << 1) - 1)
+            return index
+        if tag == _VALUE_STR:
+            value = value.encode('utf-8', 'surrogatepass')
+        elif tag != _VALUE_PICKLE:
+            indexes = bytearray()
+            for item in value:
+                _write_varint(indexes, item)
+            value = indexes
+        _write_varint(table, len(value))
+        table += value
+        return index
+
+    def items(self, items):
+        chunk = bytearray()
+        for item in items:
+            if type(item) == dictitem:
+                _write_varint(chunk, self.value(item[0]) << 2 | _ITEM_DICTITEM)
+                _write_varint(chunk, self.value(item[1]))
+            else:
+                _write_varint(chunk, self.value(item) << 2 | _ITEM_VALUE)
+        self.emit(chunk)
+
+class _ValueTable(object):
+    """
+    The value table of DataDiff.to_bytes(), decoding each value when first used
+    """
+    def __init__(self, data, pos):
+        count, pos = _read_varint(data, pos)
+        offsets = []
+        for _ in range(count):
+            offsets.append(pos)
+            n, pos = _read_varint(data, pos + 1)
+            if data[offsets[-1]] != _VALUE_INT:
+                pos += n
+        self.data = data
+        self.offsets = offsets
+        self.values = [_MISSING] * count
+        self.end = pos
+
+    def __getitem__(self, index):
+        value = self.values[index]
+        if value is not _MISSING:
+            return value
+        # containers need their items decoded first; they go on an explicit stack,
+        # for any depth of nesting
+        values = self.values
+        stack = [(index,) + self._read(index)]
+        while stack:
+            i, tag, value = stack[-1]
+            if tag in _CONTAINER_VALUES:
+                missing = [j for j in value if values[j] is _MISSING]
+                if missing:
+                    stack.extend((j,) + self._read(j) for j in missing)
+                    continue
+                items = [values[j] for j in value]
+                if tag == _VALUE_DICT:
+                    value = dict(zip(items[::2], items[1::2]))
+                else:
+                    value = _CONTAINER_VALUES[tag](items)
+            values[i] = value
+            stack.pop()
+        return values[index]
+
+    def _read(self, index):
+        data = self.data
+        pos = self.offsets[index]
+        tag = data[pos]
+        n, pos = _read_varint(data, pos + 1)
+        if tag == _VALUE_INT:
+            return tag, -((n + 1) >> 1) if n & 1 else n >> 1
+        if tag == _VALUE_STR:
+            return tag, data[pos:pos + n].decode('utf-8', 'surrogatepass')
+        if tag == _VALUE_PICKLE:
+            return tag, pickle.loads(data[pos:pos + n])
+        end = pos + n
+        indexes = []
+        while pos < end:
+            i, pos = _read_varint(data, pos)
+            indexes.append(i)
+        return tag, indexes
+
+def _encode_steps(ddiff, encoder):
+    """
+    Encode ddiff for to_bytes(), yielding each nested diff to be encoded in turn.
+
+    Everything is written back to front, so that each nested diff is done, and its
+    length known, by the time its length prefix goes in front of it.
+    """
+    ops = ddiff._ops
+    args = ddiff._args
+    for i in range(len(ops) - 1, -1, -1):
+        op = ops[i]
+        arg = args[i]
+        head = bytearray()
+        if op == _CONTEXT:
+            head.append(op)
+            for n in arg[:4]:
+                _write_varint(head, n)
+            for origin in arg[4:]:
+                _write_varint(head, 0 if origin is None else origin + 1)
+        elif op in (_CONTEXT_END, _TRUNCATED):
+            head.append(op)
+        elif op == _NESTED and type(arg) != DataDiff:
+            head.append(op)
+            head.append(0)
+            _write_varint(head, encoder.value(arg))
+        elif op == _NESTED:
+            end = encoder.size
+            yield arg
+            head.append(op)
+            _write_varint(head, encoder.size - end)
+        elif op == _OTHER:
+            head.append(op)
+            _write_varint(head, encoder.value(arg))
+        elif op == _MOVED:
+            end = encoder.size
+            yield arg[1]
+            head.append(op)
+            _write_varint(head, encoder.value(arg[0]))
+            _write_varint(head, encoder.size - end)
+        else:
+            items = list(_op_items(op, arg))
+            op = _STORED_OPS.get(op, op)
+            run_end = len(items)
+            for j in range(len(items) - 1, -1, -1):
+                item = items[j]
+                if type(item) == dictitem and type(item[1]) == DataDiff:
+                    encoder.items(items[j+1:run_end])
+                    run_end = j
+                    end = encoder.size
+                    yield item[1]
+                    item_head = bytearray()
+                    _write_varint(item_head, encoder.value(item[0]) << 2 | _ITEM_NESTED)
+                    _write_varint(item_head, encoder.size - end)
+                    encoder.emit(item_head)
+            encoder.items(items[:run_end])
+            head.append(op)
+            if op in (_DELETE, _INSERT, _EQUAL):
+                _write_varint(head, len(items))
+        encoder.emit(head)
+    head = bytearray()
+    for value in (ddiff.datatype, ddiff.type_start_str, ddiff.type_end_str,
+                  ddiff.fromfile, ddiff.tofile):
+        _write_varint(head, encoder.value(value))
+    _write_varint(head, len(ops))
+    encoder.emit(head)
+
+def hashable(s, rel_tol=0, abs_tol=0):
+    """
+    A hashable version of s, with lists and tuples as tuples, dicts and sets as
+    frozensets.  With a tolerance, numbers are rounded so that most numbers that are
+    equal within it are equal afterwards (see _quantize).
+    """
+    try:
+        ret = _hashable(s, rel_tol, abs_tol)
         # validate
         hash(ret)
     except TypeError:
@@ -191,72 +1875,680 @@ def hashable(s):
     else:
         return ret
 
-def try_diff_seq(a, b, context=3, depth=0, fromfile='a', tofile='b'):
+def _hashable_leaf(s, rel_tol, abs_tol):
+    if type(s) == set:
+        return frozenset(s)
+    if rel_tol or abs_tol:
+        return _quantize(s, rel_tol, abs_tol)
+    return s
+
+def _hashable(s, rel_tol=0, abs_tol=0):
+    # lists, tuples and dicts are converted bottom-up, from an explicit
+    # stack instead of recursing, so any depth of nesting works
+    if type(s) not in (list, tuple, dict):
+        return _hashable_leaf(s, rel_tol, abs_tol)
+    stack = [(s, iter(s.items() if type(s) == dict else s), [])]
+    while True:
+        container, children, converted = stack[-1]
+        for child in children:
+            if type(child) in (list, tuple, dict):
+                stack.append((child, iter(child.items() if type(child) == dict else child), []))
+                break
+            converted.append(_hashable_leaf(child, rel_tol, abs_tol))
+        else:
+            stack.pop()
+            ret = frozenset(converted) if type(container) == dict else tuple(converted)
+            if not stack:
+                return ret
+            stack[-1][2].append(ret)
+
+# marks quantized numbers, so they never equal anything else
+_QUANTIZED = object()
+# marks fingerprints made from DigestIndex digests
+_DIGESTED = object()
+# marks the types in strict fingerprints
+_TYPED = object()
+
+def _quantize(s, rel_tol, abs_tol):
+    """
+    Round a number to a bucket, where any two numbers in the same bucket are equal
+    within the tolerances.  Numbers that are just on either side of a bucket's edge
+    are in different buckets though, so this only finds most close numbers.
+    Anything but an int or a float is returned as is.
+    """
+    if type(s) not in (int, float):
+        return s
+    try:
+        if abs_tol and abs(s) * rel_tol <= abs_tol:
+            return _QUANTIZED, None, math.floor(s / abs_tol)
+        # numbers in one bucket differ by at most rel_tol/2 * 2**exponent,
+        # and 2**exponent <= 2 * abs(s)
+        mantissa, exponent = math.frexp(s)
+        return _QUANTIZED, exponent, math.floor(mantissa / (rel_tol / 2.0))
+    except (OverflowError, ValueError):
+        # infinities, NaN, and ints too big for a float
+        return s
+
+def _close(a, b, rel_tol, abs_tol):
+    """
+    Whether numbers a and b are equal within the tolerances, as in math.isclose
+    """
+    if type(a) not in (int, float) or type(b) not in (int, float):
+        return False
+    try:
+        return abs(a - b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
+    except OverflowError:
+        return False
+
+class _Fingerprint(object):
+    """
+    Hashable stand-in for a container of containers, as used by SequenceMatcher in
+    diff_seq.
+
+    Fingerprints are interned by _HashCache, so equal containers get the very same
+    fingerprint, and comparing two of them is just an identity check.  A container's
+    fingerprint is built from its children's, without hashing anything below them again.
+    """
+    __slots__ = ('form', 'digest')
+
+    def __init__(self, form, digest):
+        self.form = form
+        self.digest = digest
+
+    def __hash__(self):
+        return self.digest
+
+# leaves that are their own fingerprints, when there's no tolerance
+_PLAIN_LEAVES = frozenset([int, float, str, bool, type(None), bytes, complex])
+# the same, for strict diffs: leaves that are only == to values of their own type
+_STRICT_LEAVES = frozenset([str, bytes, type(None)])
+# marks the forms of dicts, so that {} and set() differ
+_DICT_FORM = object()
+# marks the forms of tuples, so that [1] and (1,) differ, as they do for ==
+_TUPLE_FORM = object()
+
+class _HashCache(object):
+    """
+    Memoizes fingerprints of containers by object identity.  Only valid while the
+    fingerprinted data is not mutated, i.e. for the duration of one top-level diff()
+
+    Leaves are their own fingerprints (or what _hashable_leaf() converts them to),
+    and so are containers of only leaves, as a tuple, or a frozenset of dict items.
+    Those are cheap to hash again, so only containers of containers get memoized,
+    as _Fingerprints.
+    """
+    def __init__(self, rel_tol=0, abs_tol=0, strict=False):
+        # id(obj) -> (obj, fingerprint); obj is kept so its id can't be reused
+        self._entries = {}
+        # form -> fingerprint of containers of containers
+        self._interned = {}
+        self.rel_tol = rel_tol
+        self.abs_tol = abs_tol
+        # strict fingerprints include the types of leaves and containers
+        self.strict = strict
+        # with a tolerance, every leaf needs converting
+        if rel_tol or abs_tol:
+            self._plain = frozenset()
+        else:
+            self._plain = _STRICT_LEAVES if strict else _PLAIN_LEAVES
+
+    def fingerprint(self, s):
+        return self.fingerprints([s])[0]
+
+    def fingerprints(self, items):
+        """
+        The fingerprints of items, as a list
+        """
+        plain = self._plain
+        fps = []
+        try:
+            for s in items:
+                if type(s) in plain:
+                    fps.append(s)
+                elif isinstance(s, (list, tuple)) or type(s) == dict:
+                    fp = self._flat(s)
+                    if fp is None:
+                        entry = self._entries.get(id(s))
+                        fp = entry[1] if entry is not None else self._fingerprint(s)
+                    fps.append(fp)
+                else:
+                    s = self._leaf(s)
+                    hash(s)
+                    fps.append(s)
+        except TypeError:
+            log.debug('hashable error', exc_info=True)
+            raise NotHashable("Hashable type required (for parent diff) but got %s with value %r" % (type(s), s))
+        return fps
+
+    def _leaf(self, s):
+        if not self.strict:
+            return _hashable_leaf(s, self.rel_tol, self.abs_tol)
+        if isinstance(s, (set, frozenset)):
+            return _TYPED, type(s), frozenset(self._leaf(item) for item in s)
+        return _TYPED, type(s), _hashable_leaf(s, self.rel_tol, self.abs_tol)
+
+    def _flat(self, s):
+        """
+        The fingerprint of a container whose children are all plain leaves, or None
+        """
+        plain = self._plain
+        if type(s) == dict:
+            if not (plain.issuperset(map(type, s)) and plain.issuperset(map(type, s.values()))):
+                return None
+            fp = _DICT_FORM, frozenset(s.items())
+        elif plain.issuperset(map(type, s)):
+            fp = (_TUPLE_FORM, tuple(s)) if isinstance(s, tuple) else tuple(s)
+        else:
+            return None
+        if self.strict:
+            return _TYPED, type(s), fp
+        return fp
+
+    def _fingerprint(self, s):
+        # containers are fingerprinted bottom-up, from an explicit
+        # stack instead of recursing, so any depth of nesting works
+        plain = self._plain
+        flat = self._flat
+        entries = self._entries
+        stack = [(s, _fingerprint_children(s), [], [False])]
+        while True:
+            container, children, done, nested = stack[-1]
+            for child in children:
+                child_type = type(child)
+                if child_type in plain:
+                    done.append(child)
+                elif child_type is dict or isinstance(child, (list, tuple)):
+                    nested[0] = True
+                    fp = flat(child)
+                    if fp is None:
+                        entry = entries.get(id(child))
+                        if entry is None:
+                            stack.append((child, _fingerprint_children(child), [], [False]))
+                            break
+                        fp = entry[1]
+                    done.append(fp)
+                else:
+                    done.append(self._leaf(child))
+            else:
+                stack.pop()
+                if type(container) == dict:
+                    fp = _DICT_FORM, frozenset(zip(done[::2], done[1::2]))
+                elif isinstance(container, tuple):
+                    fp = _TUPLE_FORM, tuple(done)
+                else:
+                    fp = tuple(done)
+                if self.strict:
+                    fp = _TYPED, type(container), fp
+                if nested[0]:
+                    fp = self._intern(fp)
+                    self._entries[id(container)] = (container, fp)
+                else:
+                    hash(fp)
+                if not stack:
+                    return fp
+                stack[-1][2].append(fp)
+
+    def _intern(self, form):
+        fp = self._interned.get(form)
+        if fp is None:
+            fp = self._interned[form] = _Fingerprint(form, hash(form))
+        return fp
+
+    def digested(self, digest):
+        """
+        The fingerprint of a value with this DigestIndex digest
+        """
+        return self._intern((_DIGESTED, digest))
+
+def _fingerprint_children(s):
+    if type(s) == dict:
+        # keys and values, alternating
+        return itertools.chain.from_iterable(s.items())
+    return iter(s)
+
+class DigestIndex(object):
+    """
+    A content digest of every dict, list, tuple and set in some data, for diff()
+    to skip the parts of two snapshots that match without walking them.
+
+    Digests are stable across processes, so an index can be saved next to its
+    snapshot, and loaded to diff it against the next one.  Values other than
+    containers are digested through pickle; values that pickle differently, like
+    1 and 1.0, or equal sets in different orders, only get walked after all.
+    """
+    def __init__(self, data=None):
+        self.root = None if data is None else _digest_tree(data)
+
+    @property
+    def digest(self):
+        """
+        The digest of the whole data, as bytes
+        """
+        return self.root.digest
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(_encode_digest_tree(self.root))
+
+    @classmethod
+    def load(cls, path):
+        """
+        The index that save() wrote to 'path'.  Like pickle, this must only be used
+        on trusted files.
+        """
+        index = cls()
+        with open(path, 'rb') as f:
+            index.root = _decode_digest_tree(f.read())
+        return index
+
+class _DigestNode(object):
+    """
+    The digest of a container, and the nodes of its children: a dict of the keys
+    of container values for a dict, a list with None for non-containers for a
+    sequence, or None for a set
+    """
+    __slots__ = ('digest', 'children')
+
+    def __init__(self, digest, children):
+        self.digest = digest
+        self.children = children
+
+def _same_digest(node_a, node_b):
+    return node_a is not None and node_b is not None and node_a.digest == node_b.digest
+
+_DIGEST_SIZE = 16
+
+def _digest_children(s):
+    """
+    (key, child) of the children of a container that get nodes, or None
+    """
+    if type(s) == dict:
+        return iter(s.items())
+    if isinstance(s, (list, tuple)):
+        return enumerate(s)
+    return None
+
+def _digest_leaf(s, parts=None):
+    """
+    The bytes a non-container (or set) contributes to its container's digest.
+    'parts' memoizes them for strs, ints and such, which are often repeated.
+    """
+    memo_key = None
+    if parts is not None and type(s) in _MEMOIZED_LEAVES:
+        memo_key = (type(s), s)
+        part = parts.get(memo_key)
+        if part is not None:
+            return part
+    if isinstance(s, (set, frozenset)):
+        part = b'C' + _digest(s, sorted(_digest_leaf(item, parts) for item in s))
+    else:
+        data = pickle.dumps(s, 2)
+        part = b'L%d:%s' % (len(data), data)
+    if memo_key is not None:
+        parts[memo_key] = part
+    return part
+
+# not floats, whose equal values like 0.0 and -0.0 pickle differently
+_MEMOIZED_LEAVES = (str, int, bool, type(None), bytes)
+
+def _digest(container, parts):
+    # the type name keeps e.g. lists and tuples of the same items apart
+    h = hashlib.blake2b(type(container).__name__.encode('utf-8'), digest_size=_DIGEST_SIZE)
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+def _digest_tree(data):
+    children = _digest_children(data)
+    if children is None:
+        if isinstance(data, (set, frozenset)):
+            return _DigestNode(_digest_leaf(data)[1:], None)
+        return _DigestNode(_digest(data, [_digest_leaf(data)]), None)
+    # containers are digested bottom-up, from an explicit stack
+    # instead of recursing, so any depth of nesting works
+    leaf_parts = {}
+    stack = [(data, children, [], {} if type(data) == dict else [], None)]
+    while True:
+        container, children, parts, nodes, key = stack[-1]
+        for child_key, child in children:
+            grandchildren = _digest_children(child)
+            if grandchildren is not None:
+                stack.append((child, grandchildren, [], {} if type(child) == dict else [],
+                               child_key))
+                break
+            part = _digest_leaf(child, leaf_parts)
+            if type(container) == dict:
+                parts.append(_digest_leaf(child_key, leaf_parts) + part)
+                if part[:1] == b'C':
+                    nodes[child_key] = _DigestNode(part[1:], None)
+            else:
+                parts.append(part)
+                nodes.append(_DigestNode(part[1:], None) if part[:1] == b'C' else None)
+        else:
+            stack.pop()
+            if type(container) == dict:
+                # dict items in any order have the same digest
+                parts.sort()
+            node = _DigestNode(_digest(container, parts), nodes)
+            if not stack:
+                return node
+            parent, _, parent_parts, parent_nodes, _ = stack[-1]
+            part = b'C' + node.digest
+            if type(parent) == dict:
+                parent_parts.append(_digest_leaf(key, leaf_parts) + part)
+                parent_nodes[key] = node
+            else:
+                parent_parts.append(part)
+                parent_nodes.append(node)
+
+# DigestIndex.save() format: _INDEX_MAGIC, then the nodes depth first.  A node is
+# its digest, then 0 for a set, or 1 for a dict and 2 for a sequence followed by a
+# varint count of children.  A dict's children are each a varint length and a
+# pickle of the key, then its node; a sequence's are each 0 for a non-container,
+# or 1 then its node.
+_INDEX_MAGIC = b'DDIDX\x01'
+_NODE_SET, _NODE_DICT, _NODE_SEQ = range(3)
+
+def _encode_digest_tree(root):
+    out = bytearray(_INDEX_MAGIC)
+    # nodes of the children still to write, with the bytes to write before each
+    stack = [iter([(b'', root)])]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        prefix, node = entry
+        out += prefix
+        if node is None:
+            continue
+        out += node.digest
+        children = node.children
+        if children is None:
+            out.append(_NODE_SET)
+        elif type(children) == dict:
+            out.append(_NODE_DICT)
+            _write_varint(out, len(children))
+            stack.append((_index_key(key), child) for key, child in children.items())
+        else:
+            out.append(_NODE_SEQ)
+            _write_varint(out, len(children))
+            stack.append((b'\x00', None) if child is None else (b'\x01', child)
+                         for child in children)
+    return bytes(out)
+
+def _index_key(key):
+    data = pickle.dumps(key, 2)
+    prefix = bytearray()
+    _write_varint(prefix, len(data))
+    return bytes(prefix + data)
+
+def _decode_digest_tree(data):
+    if not data.startswith(_INDEX_MAGIC):
+        raise ValueError('Not a saved DigestIndex')
+    pos = len(_INDEX_MAGIC)
+    # [node, its kind, how many children are left to read]
+    stack = []
+    root = None
+    while root is None or stack:
+        if stack:
+            parent, kind, left = stack[-1]
+            if not left:
+                stack.pop()
+                continue
+            stack[-1][2] -= 1
+            if kind == _NODE_DICT:
+                n, pos = _read_varint(data, pos)
+                key = pickle.loads(data[pos:pos + n])
+                pos += n
+            else:
+                pos += 1
+                if data[pos - 1] == 0:
+                    parent.children.append(None)
+                    continue
+        digest = data[pos:pos + _DIGEST_SIZE]
+        kind = data[pos + _DIGEST_SIZE]
+        pos += _DIGEST_SIZE + 1
+        node = _DigestNode(digest, None)
+        if kind != _NODE_SET:
+            node.children = {} if kind == _NODE_DICT else []
+            count, pos = _read_varint(data, pos)
+            stack_entry = [node, kind, count]
+        if root is None:
+            root = node
+        elif type(parent.children) == dict:
+            parent.children[key] = node
+        else:
+            parent.children.append(node)
+        if kind != _NODE_SET:
+            stack.append(stack_entry)
+    return root
+
+def try_diff_seq(a, b, context=3, depth=0, fromfile='a', tofile='b', _run=None):
     """
     Safe to try any containers with this function, to see if it might be a sequence
     Raises TypeError if its not a sequence
     """
+    if _run is None:
+        _run = _DiffRun()
     try:
-        return diff_seq(a, b, context, depth, fromfile=fromfile, tofile=tofile)
+        return _drive(_diff_seq_steps(a, b, context, depth, fromfile, tofile, _run), None, _run)
     except NotHashable:
         raise
     except:
         log.debug('tried SequenceMatcher but got error', exc_info=True)
         raise NotSequence("Cannot use SequenceMatcher on %s" % type(a))
 
-def diff_seq(a, b, context=3, depth=0, fromfile='a', tofile='b'):
+def diff_seq(a, b, context=3, depth=0, fromfile='a', tofile='b', matcher='difflib', _run=None):
+    if _run is None:
+        _run = _DiffRun(matcher)
+    return _drive(_diff_seq_steps(a, b, context, depth, fromfile, tofile, _run), None, _run)
+
+def _diff_seq_steps(a, b, context, depth, fromfile, tofile, _run):
     if not hasattr(a, '__iter__') and not hasattr(a, '__getitem__'):
         raise NotSequence("Not a sequence %s" % type(a))
-    hashable_a = [hashable(_) for _ in a]
-    hashable_b = [hashable(_) for _ in b]
-    sm = SequenceMatcher(a = hashable_a, b = hashable_b)
+    nodes_a, nodes_b = _run.index_children(a, b)
+    if (type(nodes_a) != list or type(nodes_b) != list
+            or len(nodes_a) != len(a) or len(nodes_b) != len(b)):
+        nodes_a = nodes_b = None
+    # fingerprints are shared with the nested diffs of 'replace' chunks below,
+    # so each subtree only gets hashed once per top-level diff()
+    with _run.timed('fingerprint'):
+        if nodes_a is not None and not (_run.rel_tol or _run.abs_tol):
+            # items with digests don't need hashing at all
+            hashable_a = [_run.hashes.fingerprint(item) if node is None
+                          else _run.hashes.digested(node.digest)
+                          for item, node in zip(a, nodes_a)]
+            hashable_b = [_run.hashes.fingerprint(item) if node is None
+                          else _run.hashes.digested(node.digest)
+                          for item, node in zip(b, nodes_b)]
+        else:
+            hashable_a = _run.hashes.fingerprints(a)
+            hashable_b = _run.hashes.fingerprints(b)
     if type(a) == tuple:
         ddiff = DataDiff(tuple, '(', ')', fromfile=fromfile, tofile=tofile)
     elif type(b) == list:
         ddiff = DataDiff(list, '[', ']', fromfile=fromfile, tofile=tofile)
     else:
         ddiff = DataDiff(type(a), fromfile=fromfile, tofile=tofile)
-    for chunk in sm.get_grouped_opcodes(context):
+    keys_a = keys_b = None
+    if _run.key is not None:
+        keys_a = _item_keys(a, _run.key)
+        keys_b = _item_keys(b, _run.key)
+    # b index -> a index of items that moved, and changed, by their keys
+    moved_from = None
+    with _run.timed('match'):
+        if keys_a is not None and keys_b is not None:
+            opcodes = list(keyed_opcodes(keys_a, keys_b, hashable_a, hashable_b, _run.matcher))
+            moved_from = _moved_items(opcodes, keys_a, keys_b, hashable_a, hashable_b)
+        else:
+            if _run.key is not None:
+                _run.slow_path('items without keys')
+            opcodes = _run.matcher(hashable_a, hashable_b)
+    for chunk in group_opcodes(opcodes, context):
+        if _run.out_of_budget():
+            break
         ddiff.context(max(chunk[0][1]-1,0), max(chunk[-1][2]-1, 0),
-                     max(chunk[0][3]-1,0), max(chunk[-1][4]-1, 0))
+                     max(chunk[0][3]-1,0), max(chunk[-1][4]-1, 0),
+                     chunk[0][1], chunk[0][3])
         for change, i1, i2, j1, j2 in chunk:
+            if _run.out_of_budget():
+                break
             if change == 'replace':
-                consecutive_deletes = []
-                consecutive_inserts = []
-                for a2, b2 in zip(a[i1:i2], b[j1:j2]):
+                # items that can't be diffed pairwise are deleted and inserted as
+                # runs of a[i1+run_start:i1+end] and b[j1+run_start:j1+end]
+                common_length = min(i2-i1, j2-j1)
+                run_start = end = 0
+                for k in range(common_length):
+                    if _run.out_of_budget():
+                        break
+                    if _compare_directly(a[i1+k], b[j1+k]):
+                        # no nested diff to try; this pair is deleted and inserted
+                        if _run.close(a[i1+k], b[j1+k]):
+                            # close numbers in different quantization buckets
+                            ddiff.delete_range(a, i1+run_start, i1+k)
+                            ddiff.insert_range(b, j1+run_start, j1+k)
+                            run_start = k+1
+                            ddiff.equal(a[i1+k])
+                            _run.slow_path('close numbers paired')
+                        else:
+                            _run.spend(1)
+                        end = k+1
+                        continue
+                    if nodes_a is not None:
+                        _run.index_pair(a[i1+k], b[j1+k], nodes_a[i1+k], nodes_b[j1+k])
                     try:
-                        nested_diff = diff(a2, b2, context, depth+1)
-                        ddiff.delete_multi(consecutive_deletes)
-                        ddiff.insert_multi(consecutive_inserts)
-                        consecutive_deletes = []
-                        consecutive_inserts = []
-                        ddiff.nested(nested_diff)
+                        nested_diff = yield a[i1+k], b[j1+k], context, depth+1
+                        ddiff.delete_range(a, i1+run_start, i1+k)
+                        ddiff.insert_range(b, j1+run_start, j1+k)
+                        run_start = k+1
+                        if nested_diff:
+                            ddiff.nested(nested_diff)
+                        else:
+                            # equal after all, e.g. items whose numbers are of
+                            # types that digests tell apart, or within tolerance
+                            ddiff.equal(a[i1+k])
                     except DiffTypeError:
-                        consecutive_deletes.append(a2)
-                        consecutive_inserts.append(b2)
-                
+                        _run.slow_path('nested diff failed')
+                        _run.spend(1)
+                    end = k+1
+
                 # differing lengths get truncated by zip()
                 # here we handle the truncated items
-                ddiff.delete_multi(consecutive_deletes)
+                ddiff.delete_range(a, i1+run_start, i1+end)
                 if i2-i1 > j2-j1:
-                    common_length = j2-j1 # covered by zip
-                    ddiff.delete_multi(a[i1+common_length:i2])
-                ddiff.insert_multi(consecutive_inserts)
+                    start = i1+common_length
+                    ddiff.delete_range(a, start, start + _run.allow(i2-start))
+                ddiff.insert_range(b, j1+run_start, j1+end)
                 if i2-i1 < j2-j1:
-                    common_length = i2-i1 # covered by zip
-                    ddiff.insert_multi(b[j1+common_length:j2])
+                    start = j1+common_length
+                    ddiff.insert_range(b, start, start + _run.allow(j2-start))
+            elif change == 'insert' and moved_from:
+                # items moved here from elsewhere in a get a nested diff against
+                # their old selves; the rest are inserted as runs of b[run_start:j]
+                run_start = j1
+                for j in range(j1, j2):
+                    i = moved_from.get(j)
+                    if i is None or _run.out_of_budget():
+                        continue
+                    if nodes_a is not None:
+                        _run.index_pair(a[i], b[j], nodes_a[i], nodes_b[j])
+                    try:
+                        nested_diff = yield a[i], b[j], context, depth+1
+                    except DiffTypeError:
+                        _run.slow_path('nested diff failed')
+                        continue
+                    ddiff.insert_range(b, run_start, run_start + _run.allow(j-run_start))
+                    run_start = j+1
+                    if nested_diff:
+                        ddiff.moved(b[j], nested_diff)
+                    else:
+                        ddiff.insert(b[j])
+                ddiff.insert_range(b, run_start, run_start + _run.allow(j2-run_start))
+            elif change == 'insert':
+                ddiff.insert_range(b, j1, j1 + _run.allow(j2-j1))
+            elif change == 'delete':
+                ddiff.delete_range(a, i1, i1 + _run.allow(i2-i1))
             else:
-                if change == 'insert':
-                    items = b[j1:j2]
-                else:
-                    items = a[i1:i2]
-                ddiff.multi(change, items)
+                ddiff.equal_range(a, i1, i2)
+        if _run.truncated:
+            break
         if i2 < len(a):
             ddiff.context_end_container()
+    if _run.truncated:
+        ddiff.truncated()
     return ddiff
 
+def _item_keys(items, key):
+    """
+    key(item) for every item, or None if some item has no (hashable) key
+    """
+    keys = []
+    for item in items:
+        try:
+            k = key(item)
+            hash(k)
+        except (KeyError, IndexError, AttributeError, TypeError):
+            return None
+        keys.append(k)
+    return keys
+
+def keyed_opcodes(keys_a, keys_b, a, b, matcher=difflib_opcodes):
+    """
+    Opcodes aligning a and b by their items' keys.  Runs of matching keys are split
+    into 'equal' runs, and 'replace' runs of same-keyed items that differ (judging
+    by a == b).  Items without a matching key are only ever deleted or inserted.
+    """
+    for change, i1, i2, j1, j2 in matcher(keys_a, keys_b):
+        if change == 'equal':
+            same_items = itertools.groupby(range(i1, i2), lambda i: a[i] == b[j1+i-i1])
+            for same, run in same_items:
+                count = sum(1 for _ in run)
+                yield ('equal' if same else 'replace'), i1, i1+count, j1, j1+count
+                i1 += count
+                j1 += count
+        else:
+            if i2 > i1:
+                yield 'delete', i1, i2, j1, j1
+            if j2 > j1:
+                yield 'insert', i2, i2, j1, j2
+
+def _moved_items(opcodes, keys_a, keys_b, a, b):
+    """
+    {j: i} of the items b[j] that opcodes insert, where a[i] had the same key but
+    is deleted elsewhere, and differs (judging by a == b)
+    """
+    deleted = {}
+    for change, i1, i2, j1, j2 in opcodes:
+        if change == 'delete':
+            for i in range(i1, i2):
+                deleted[keys_a[i]] = i
+    moved = {}
+    if deleted:
+        for change, i1, i2, j1, j2 in opcodes:
+            if change == 'insert':
+                for j in range(j1, j2):
+                    i = deleted.get(keys_b[j])
+                    if i is not None and a[i] != b[j]:
+                        moved[j] = i
+    return moved
+
+def _compare_directly(a, b):
+    """
+    True for values that diff() can't diff, so that == alone decides if they changed
+    """
+    if type(a) != type(b):
+        return True
+    handler = _handler_for(type(a))
+    if handler is _str_steps:
+        return '\n' not in a and '\n' not in b
+    return handler is None
 
 class dictitem(tuple):
+    __slots__ = ()
+    # nested diffs of dict values are rendered one level in
+    depth = 1
+
     def __repr__(self):
         key, val = self
         if type(val) == DataDiff:
@@ -264,52 +2556,278 @@ class dictitem(tuple):
             return "%r: %s" % (key, diff_val.strip())
         return "%r: %r" % (key, val)
 
-def diff_dict(a, b, context=3, depth=0, fromfile='a', tofile='b'):
+def diff_dict(a, b, context=3, depth=0, fromfile='a', tofile='b', _run=None):
+    if _run is None:
+        _run = _DiffRun()
+    return _drive(_diff_dict_steps(a, b, context, depth, fromfile, tofile, _run), None, _run)
+
+def _diff_dict_steps(a, b, context, depth, fromfile, tofile, _run):
     ddiff = DataDiff(dict, '{', '}', fromfile=fromfile, tofile=tofile)
-    for key in a.keys():
-        if key not in b:
-            ddiff.delete(dictitem((key, a[key])))
-        elif a[key] != b[key]:
+    # (sort key, op, dictitem) of the changed keys and the first 'context' unchanged
+    # ones, to be sorted by key before they go in ddiff
+    entries = []
+    unchanged = 0
+    nodes_a, nodes_b = _run.index_children(a, b)
+    if type(nodes_a) != dict or type(nodes_b) != dict:
+        nodes_a = None
+    for key, a_val in a.items():
+        if _run.out_of_budget():
+            break
+        b_val = b.get(key, _MISSING)
+        if b_val is _MISSING and key not in b:
+            entries.append((_stable_order(key), _DELETE_ONE, dictitem((key, a_val))))
+            _run.spend(1)
+            continue
+        # a cheap equality check settles unchanged values, so that
+        # nested diffs are only built for the changed ones
+        nested_diff = None
+        if a_val is b_val:
+            changed = False
+        elif _compare_directly(a_val, b_val):
+            changed = a_val != b_val and not _run.close(a_val, b_val)
+            if _run.strict and type(a_val) != type(b_val):
+                changed = True
+        elif nodes_a is not None and _same_digest(nodes_a.get(key), nodes_b.get(key)):
+            changed = False
+        elif _run.same(a_val, b_val):
+            changed = False
+        else:
+            if nodes_a is not None:
+                _run.index_pair(a_val, b_val, nodes_a.get(key), nodes_b.get(key))
             try:
-                nested_diff = diff(a[key], b[key], context, depth+1)
-                nested_item = dictitem((key, nested_diff))
-                nested_item.depth = depth+1
-                ddiff.equal(nested_item) ########### not really equal
+                nested_diff = yield a_val, b_val, context, depth+1
             except DiffTypeError:
-                ddiff.delete(dictitem((key, a[key])))
-                ddiff.insert(dictitem((key, b[key])))
-        else:
-            if context:
-                ddiff.equal(dictitem((key, a[key])))
-            context -= 1
-    for key in b:
-        if key not in a:
-            ddiff.insert(dictitem((key, b[key])))
-
-    def diffitem_dictitem_sort_key(diffitem):
-        change, dictitem = diffitem
-        if type(dictitem) == DataDiff:
-            return 0
-        key = dictitem[0][0]
-        # use hash, to make sure its always orderable against other potential key types
-        basestring = basestring if sys.version[0] == 2 else str
-        if isinstance(key, basestring) or isinstance(key, Number):
-            return key
+                _run.slow_path('nested diff failed')
+                changed = not _run.same(a_val, b_val)
+            else:
+                changed = bool(nested_diff)
+        if changed and nested_diff is not None:
+            entries.append((_stable_order(key), _NESTED_ITEM, dictitem((key, nested_diff))))
+        elif changed:
+            order = _stable_order(key)
+            entries.append((order, _DELETE_ONE, dictitem((key, a_val))))
+            entries.append((order, _INSERT_ONE, dictitem((key, b_val))))
+            _run.spend(1)
         else:
-            return abs(hash(key)) # abs for consistency between py2/3, at least for datetime
-    ddiff.diffs.sort(key=diffitem_dictitem_sort_key)
+            # only the first 'context' unchanged keys are shown
+            if unchanged < context:
+                entries.append((_stable_order(key), _EQUAL_ONE, dictitem((key, a_val))))
+            unchanged += 1
+    for key in b.keys() - a.keys():
+        if _run.out_of_budget():
+            break
+        entries.append((_stable_order(key), _INSERT_ONE, dictitem((key, b[key]))))
+        _run.spend(1)
 
-    if context < 0:
+    with _run.timed('dict sort'):
+        # stable, so a changed key's delete stays before its insert
+        entries.sort(key=operator.itemgetter(0))
+    for order, op, item in entries:
+        ddiff._append(op, item)
+
+    if unchanged > context:
         ddiff.context_end_container()
+    if _run.truncated:
+        ddiff.truncated()
 
     return ddiff
 
-def diff_set(a, b, context=3, depth=0, fromfile='b', tofile='a'):
+_MISSING = object()
+
+def _stable_order(key):
+    """
+    Sort key for dict keys or set items of any mix of types: numbers, then strings,
+    then anything else by hash
+    """
+    if isinstance(key, str):
+        return 1, key
+    if isinstance(key, Number) and not isinstance(key, complex):
+        return 0, key
+    # abs for consistency between py2/3, at least for datetime
+    return 2, abs(hash(key))
+
+def diff_set(a, b, context=3, depth=0, fromfile='b', tofile='a', _run=None):
+    if _run is None:
+        _run = _DiffRun()
+    return _diff_set(a, b, context, depth, fromfile, tofile, _run)
+
+def _diff_set(a, b, context, depth, fromfile, tofile, _run):
     ddiff = DataDiff(type(a), fromfile=fromfile, tofile=tofile)
-    ddiff.delete_multi(a - b)
-    ddiff.insert_multi(b - a)
-    equal = list(a.intersection(b))
+    tolerant = _run.rel_tol or _run.abs_tol
+    # without a tolerance, items past the change budget aren't needed,
+    # beyond one to tell that it ran out
+    limit = None
+    if _run.changes_left is not None and not tolerant:
+        limit = max(_run.changes_left, 0) + 1
+    if _run.strict:
+        # items are looked up by their fingerprints, so that
+        # == items of other types, like 1 and True, differ
+        items_a = dict(zip(_run.hashes.fingerprints(a), a))
+        items_b = dict(zip(_run.hashes.fingerprints(b), b))
+        deleted = [items_a[fp] for fp in _only_in(items_a, items_b, limit)]
+        inserted = [items_b[fp] for fp in _only_in(items_b, items_a, limit)]
+        common = (item for fp, item in items_a.items() if fp in items_b)
+    else:
+        deleted = _only_in(a, b, limit)
+        inserted = _only_in(b, a, limit)
+        common = (item for item in a if item in b)
+    close = []
+    if deleted and inserted and tolerant:
+        deleted, inserted, close = _match_close(deleted, inserted, _run.rel_tol, _run.abs_tol)
+    # just enough equal items for the context, plus one to tell if there are more
+    common = itertools.chain(common, close)
+    if _run.sort_sets:
+        deleted.sort(key=_stable_order)
+        inserted.sort(key=_stable_order)
+        equal = heapq.nsmallest(context + 1, common, key=_stable_order)
+    else:
+        equal = list(itertools.islice(common, context + 1))
+    ddiff.delete_multi(deleted[:_run.allow(len(deleted))])
+    ddiff.insert_multi(inserted[:_run.allow(len(inserted))])
     ddiff.equal_multi(equal[:context])
     if len(equal) > context:
         ddiff.context_end_container()
+    if _run.truncated:
+        ddiff.truncated()
+    return ddiff
+
+def _only_in(a, b, limit=None):
+    """
+    Items of a that aren't in b, up to 'limit' of them
+    """
+    items = []
+    for item in a:
+        if item not in b:
+            items.append(item)
+            if len(items) == limit:
+                break
+    return items
+
+def diff_set_counts(a, b):
+    """
+    How many items are only in set a, only in set b, and in both, without
+    building any of those sets
+    """
+    if len(a) <= len(b):
+        both = sum(1 for item in a if item in b)
+    else:
+        both = sum(1 for item in b if item in a)
+    return len(a) - both, len(b) - both, both
+
+def _match_close(deleted, inserted, rel_tol, abs_tol):
+    """
+    Pair up numbers in 'deleted' and 'inserted' that are equal within the tolerances,
+    looking them up by quantized value (and the buckets next to it).
+    Returns the unpaired deleted and inserted items, and the paired deleted ones.
+    """
+    buckets = {}
+    for item in inserted:
+        bucket = _quantize(item, rel_tol, abs_tol)
+        # non-numbers come back as they are, even tuples
+        if bucket is not item:
+            buckets.setdefault(bucket, []).append(item)
+    paired = set()
+    unpaired_deleted = []
+    close = []
+    for item in deleted:
+        bucket = _quantize(item, rel_tol, abs_tol)
+        if bucket is not item:
+            marker, group, n = bucket
+            for candidates in (buckets.get((marker, group, n + k)) for k in (0, -1, 1)):
+                match = next((c for c in candidates or () if id(c) not in paired
+                              and _close(item, c, rel_tol, abs_tol)), None)
+                if match is not None:
+                    paired.add(id(match))
+                    close.append(item)
+                    break
+            else:
+                unpaired_deleted.append(item)
+        else:
+            unpaired_deleted.append(item)
+    unpaired_inserted = [item for item in inserted if id(item) not in paired]
+    return unpaired_deleted, unpaired_inserted, close
+
+def _is_ndarray_type(cls):
+    # numpy is optional; if it isn't imported, cls can't be one of its arrays
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and issubclass(cls, numpy.ndarray)
+
+def diff_ndarray(a, b, context=3, depth=0, fromfile='a', tofile='b', rtol=0, atol=0, _run=None):
+    """
+    Diff numpy arrays of the same shape, finding the differing elements with
+    vectorized comparisons, where numbers within 'atol' + 'rtol' * abs(b) count as
+    equal (as in numpy.isclose).  NaNs are equal to each other.
+
+    Elements are shown in the same hunks as sequences, and those of multidimensional
+    arrays are shown with their index.  1-d arrays of different lengths are diffed as
+    sequences; other shapes that differ raise DiffTypeError.
+    """
+    import numpy
+    if _run is None:
+        _run = _DiffRun()
+    if a.shape != b.shape:
+        if a.ndim == b.ndim == 1:
+            return diff_seq(a.tolist(), b.tolist(), context, depth, fromfile, tofile, _run=_run)
+        raise DiffTypeError('Shapes differ: %s=%s %s=%s' % (fromfile, a.shape, tofile, b.shape))
+    flat_a = a.ravel()
+    flat_b = b.ravel()
+    # tolerances only apply to numbers, not e.g. strs, datetimes or objects
+    numeric = a.dtype.kind in 'biufc' and b.dtype.kind in 'biufc'
+    if numeric and (a.dtype.kind in 'fc' or b.dtype.kind in 'fc'):
+        differs = ~numpy.isclose(flat_a, flat_b, rtol=rtol, atol=atol, equal_nan=True)
+    elif numeric and (rtol or atol):
+        differs = ~numpy.isclose(flat_a, flat_b, rtol=rtol, atol=atol)
+    else:
+        differs = numpy.asarray(flat_a != flat_b)
+
+    def value(element):
+        # numpy scalars as Python values; elements of object arrays already are
+        return element.item() if isinstance(element, numpy.generic) else element
+    if a.ndim == 1:
+        item = lambda flat, i: value(flat[i])
+    else:
+        item = lambda flat, i: dictitem((tuple(int(n) for n in numpy.unravel_index(i, a.shape)),
+                                         value(flat[i])))
+    ddiff = DataDiff(numpy.ndarray, 'array([', '])', fromfile=fromfile, tofile=tofile)
+    for chunk in group_opcodes(_mismatch_opcodes(numpy.flatnonzero(differs), len(flat_a)), context):
+        if _run.out_of_budget():
+            break
+        ddiff.context(max(chunk[0][1]-1,0), max(chunk[-1][2]-1, 0),
+                     max(chunk[0][3]-1,0), max(chunk[-1][4]-1, 0),
+                     chunk[0][1], chunk[0][3])
+        for change, i1, i2, j1, j2 in chunk:
+            if change == 'equal':
+                ddiff.equal_multi([item(flat_a, i) for i in range(i1, i2)])
+                continue
+            end = i1 + _run.allow(i2-i1)
+            ddiff.delete_multi([item(flat_a, i) for i in range(i1, end)])
+            ddiff.insert_multi([item(flat_b, i) for i in range(i1, end)])
+            if _run.truncated:
+                break
+        if _run.truncated:
+            break
+        if i2 < len(flat_a):
+            ddiff.context_end_container()
+    if _run.truncated:
+        ddiff.truncated()
     return ddiff
+
+def _mismatch_opcodes(indexes, length):
+    """
+    Opcodes for two same-length sequences that differ at the sorted 'indexes'
+    """
+    if not len(indexes):
+        return
+    # split the indexes into runs of consecutive ones
+    breaks = (indexes[1:] != indexes[:-1] + 1).nonzero()[0] + 1
+    starts = [indexes[0]] + indexes[breaks].tolist()
+    stops = indexes[breaks - 1].tolist() + [indexes[-1]]
+    position = 0
+    for start, stop in zip(starts, stops):
+        start, stop = int(start), int(stop) + 1
+        if start > position:
+            yield 'equal', position, start, position, start
+        yield 'replace', start, stop, start, stop
+        position = stop
+    if position < length:
+        yield 'equal', position, length, position, length
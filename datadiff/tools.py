@@ -21,12 +21,17 @@ from datadiff import diff, DiffTypeError
 
 # drop-in replacements for http://somethingaboutorange.com/mrl/projects/nose/doc/module_nose.tools.html
 
-def assert_equal(first, second, msg=None):
+def assert_equal(first, second, msg=None, max_changes=None, max_time=None, key=None):
+    """
+    max_changes and max_time (in seconds) bound how much of the difference gets
+    computed and shown, for comparisons of huge objects.  key matches up the items
+    of sequences by an identity.  See datadiff.diff()
+    """
     if first == second:
         return
     if msg is None:
         try:
-            ddiff = diff(first, second)
+            ddiff = diff(first, second, max_changes=max_changes, max_time=max_time, key=key)
         except DiffTypeError:
             msg = '%r != %r' % (first, second)
         else:
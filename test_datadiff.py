@@ -2,10 +2,17 @@ from textwrap import dedent
 from datetime import datetime
 import sys
 import re
+import pickle
+import os
+import tempfile
+import difflib
 
 from nose.tools import assert_raises, assert_equal, raises
+from nose.plugins.skip import SkipTest
 
-from datadiff import diff, DataDiff, NotHashable, DiffNotImplementedForType, DiffTypeError
+import datadiff
+from datadiff import diff, hashable, DataDiff, NotHashable, DiffNotImplementedForType, DiffTypeError
+from datadiff import patch, unpatch, PatchError, DigestIndex
 
 # support 3.0/2.7 set literals, and <2.7
 set_start, set_end = repr(set([0])).split('0')
@@ -45,6 +52,69 @@ def test_diff_multiline_strings():
          ghi''')
     assert_equal(str(d), expected)
 
+def test_diff_large_multiline_strings():
+    lines = ['line %d' % i for i in range(100000)]
+    a = '\n'.join(lines)
+    lines[50000] = 'changed'
+    lines.insert(70000, 'inserted')
+    b = '\n'.join(lines) + '\n'
+    expected = '\n'.join(difflib.unified_diff(a.split('\n'), b.split('\n'), 'x', 'y', lineterm=''))
+    assert len(a) + len(b) >= datadiff.LARGE_TEXT_SIZE
+    assert_equal(str(diff(a, b, fromfile="x", tofile="y")), expected)
+
+def test_unified_diff_large():
+    for a, b in [('abc\ndef\nghi', 'abc\nghi'), ('abc', 'abc\n'), ('\nabc', 'abc'),
+                 ('abc\ndef', 'abc\ndef'), ('', 'abc\ndef'), ('abc\ndef', 'abd\ndef')]:
+        for context in (0, 1, 3):
+            expected = list(difflib.unified_diff(a.split('\n'), b.split('\n'), 'x', 'y',
+                                                 n=context, lineterm=''))
+            assert_equal(list(datadiff.unified_diff_large(a, b, 'x', 'y', context=context)),
+                         expected)
+
+def test_diff_files():
+    a = ''.join('line %d\n' % i for i in range(3000))
+    b = a.replace('line 1\n', 'changed\n', 1) + 'more'
+    fd_a, path_a = tempfile.mkstemp()
+    fd_b, path_b = tempfile.mkstemp()
+    try:
+        os.write(fd_a, a.encode('utf-8'))
+        os.write(fd_b, b.encode('utf-8'))
+        os.close(fd_a)
+        os.close(fd_b)
+        expected = datadiff.unified_diff_strings(a, b, fromfile=path_a, tofile=path_b)
+        assert_equal(datadiff.diff_files(path_a, path_b), expected)
+        assert_equal(datadiff.diff_files(path_a, path_a), '')
+    finally:
+        os.remove(path_a)
+        os.remove(path_b)
+
+def test_unified_diff_large_first_and_last_lines():
+    # only the lines around the differences are split up
+    lines = ['line %d' % i for i in range(100000)]
+    a = '\n'.join(lines)
+    lines[0] = 'first'
+    lines[-1] = 'last'
+    lines.insert(50000, 'inserted')
+    b = '\n'.join(lines)
+    expected = list(difflib.unified_diff(a.split('\n'), b.split('\n'), 'x', 'y', lineterm=''))
+    assert_equal(list(datadiff.unified_diff_large(a, b, 'x', 'y')), expected)
+    assert_equal(list(datadiff.unified_diff_large(a.encode('utf-8'), b.encode('utf-8'), 'x', 'y')),
+                 expected)
+
+def test_diff_files_empty():
+    fd_a, path_a = tempfile.mkstemp()
+    fd_b, path_b = tempfile.mkstemp()
+    try:
+        os.write(fd_b, b'abc\n')
+        os.close(fd_a)
+        os.close(fd_b)
+        expected = datadiff.unified_diff_strings('', 'abc\n', fromfile=path_a, tofile=path_b)
+        assert_equal(datadiff.diff_files(path_a, path_b), expected)
+        assert_equal(datadiff.diff_files(path_a, path_a), '')
+    finally:
+        os.remove(path_a)
+        os.remove(path_b)
+
 def test_diff_list():
     a = [1,'xyz', 2, 3, 4, 5]
     b = [1,'abc', 2, 4, 6]
@@ -298,6 +368,33 @@ def test_equal():
 def test_diff_types():
     d = diff([1], {1:1}, fromfile="x", tofile="y")
 
+def test_diff_types_message():
+    try:
+        diff([1], {1: 1}, fromfile="x", tofile="y")
+    except DiffTypeError:
+        e = sys.exc_info()[1]
+        assert_equal(str(e), "Types differ: x=y %s=%s  Values of a and b are: [1], {1: 1}"
+                     % (list, dict))
+    else:
+        raise AssertionError("Should've raised a DiffTypeError")
+
+def test_diff_seq_changed_scalars():
+    d = diff([1, 'a', None, 2.0], [3, 'b', 5, 4.0], fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        [
+        @@ -0,3 +0,3 @@
+        -1,
+        -'a',
+        -None,
+        -2.0,
+        +3,
+        +'b',
+        +5,
+        +4.0,
+        ]'''))
+
 @raises(Exception)
 def test_DataDiff_init_params():
     DataDiff(list, '[')
@@ -432,3 +529,848 @@ def test_nested_unhashable2():
          },
         ]''')
     assert_equal(str(d), expected)
+
+def test_fingerprints_reused_by_nested_diffs():
+    from datadiff import _HashCache
+    inner = [[1, 2], {'a': [3]}]
+    outer = [inner, 'x']
+    cache = _HashCache()
+    fp = cache.fingerprint(outer)
+    assert cache.fingerprint(inner) is fp.form[0]
+    assert cache.fingerprint(inner[1]) is fp.form[0].form[1]
+    assert_equal(cache.fingerprint([[1, 2], {'a': [3]}]), cache.fingerprint(inner))
+    assert cache.fingerprint([[1, 2], {'a': [4]}]) != cache.fingerprint(inner)
+
+def test_deeply_nested_list():
+    a = [[[[1, 2, 3]]], 4]
+    b = [[[[1, 5, 3]]], 4]
+    d = diff(a, b, fromfile="x", tofile="y")
+    expected = dedent('''\
+        --- x
+        +++ y
+        [
+        @@ -0,1 +0,1 @@
+         [
+         @@ -0 +0 @@
+           [
+          @@ -0 +0 @@
+             [
+           @@ -0,2 +0,2 @@
+            1,
+           -2,
+           +5,
+            3,
+           ],
+          ],
+         ],
+         4,
+        ]''')
+    assert_equal(str(d), expected)
+
+def test_diff_list_myers():
+    a = [1,'xyz', 2, 3, 4, 5]
+    b = [1,'abc', 2, 4, 6]
+    assert_equal(str(diff(a, b, matcher='myers')), str(diff(a, b)))
+
+def test_diff_list_context_myers():
+    a = [1]*50 + [2, 3, 4, 5, 6, 7, 8] + [1]*10
+    b = [1]*50 + [3, 9, 10] + [1]*10
+    assert_equal(str(diff(a, b, matcher='myers')), str(diff(a, b)))
+
+def test_diff_list_myers_unrelated():
+    # too many differences to find them all, so SequenceMatcher matches the rest
+    a = list(range(4000))
+    b = list(range(4000, 8000))
+    assert_equal(str(diff(a, b, matcher='myers')), str(diff(a, b)))
+    b = [1, 2] + [-n for n in a[2:-1]] + [3999]
+    assert_equal(str(diff(a, b, matcher='myers')), str(diff(a, b)))
+
+def test_diff_list_myers_no_autojunk():
+    # SequenceMatcher treats the popular 0 as junk, in sequences over 200 items
+    a = [0, 1] * 150
+    b = [0, 1] * 75 + [0, 2] + [0, 1] * 74
+    d = diff(a, b, matcher='myers', fromfile="x", tofile="y")
+    expected = dedent('''\
+        --- x
+        +++ y
+        [
+        @@ -147,154 +147,154 @@
+         0,
+         1,
+         0,
+        -1,
+        +2,
+         0,
+         1,
+         0,
+        @@  @@
+        ]''')
+    assert_equal(str(d), expected)
+
+def test_diff_custom_matcher():
+    def everything_replaced(a, b):
+        return [('replace', 0, len(a), 0, len(b))]
+    d = diff([1, 2], [1, 2], matcher=everything_replaced, fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        [
+        @@ -0,1 +0,1 @@
+        -1,
+        -2,
+        +1,
+        +2,
+        ]'''))
+
+@raises(ValueError)
+def test_diff_unknown_matcher():
+    diff([1], [2], matcher='nope')
+
+def test_diff_seq_key():
+    a = [dict(id=1, v=1), dict(id=2, v=2), dict(id=3, v=3)]
+    b = [dict(id=1, v=1), dict(id=4, v=4), dict(id=3, v=30)]
+    d = diff(a, b, key='id', fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        [
+        @@ -0,2 +0,2 @@
+         {'id': 1, 'v': 1},
+        -{'id': 2, 'v': 2},
+        +{'id': 4, 'v': 4},
+         {
+          'id': 3,
+         -'v': 3,
+         +'v': 30,
+         },
+        ]'''))
+
+def test_diff_seq_key_function():
+    a = [(1, 'a'), (2, 'b')]
+    b = [(2, 'b'), (1, 'a')]
+    d = diff(a, b, key=lambda item: item[0], fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        [
+        @@ -0,1 +0,1 @@
+        +(2, 'b'),
+         (1, 'a'),
+        -(2, 'b'),
+        ]'''))
+
+def test_diff_seq_key_moved():
+    # records that moved and changed get a nested diff where they are in b
+    a = [dict(id=1, v=1), dict(id=2, v=2), dict(id=3, v=3)]
+    b = [dict(id=3, v=30), dict(id=1, v=1), dict(id=2, v=2)]
+    d = diff(a, b, key='id', fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        [
+        @@ -0,2 +0,2 @@
+         {
+          'id': 3,
+         -'v': 3,
+         +'v': 30,
+         },
+         {'id': 1, 'v': 1},
+         {'id': 2, 'v': 2},
+        -{'id': 3, 'v': 3},
+        ]'''))
+    assert_equal(patch(a, d), b)
+    assert_equal(unpatch(b, d), a)
+    assert_equal(str(DataDiff.from_bytes(d.to_bytes())), str(d))
+
+def test_diff_seq_key_missing():
+    # items without the key are diffed as usual
+    assert_equal(str(diff([1, 2], [1, 3], key='id')), str(diff([1, 2], [1, 3])))
+
+def test_diff_dict_workers():
+    from concurrent.futures import ThreadPoolExecutor
+    a = dict(('k%d' % i, dict(x=[1, 2, i], y=i)) for i in range(20))
+    b = dict(('k%d' % i, dict(x=[1, 2, -i], y=i)) for i in range(20))
+    a['t'] = 1
+    b['t'] = [1]
+    expected = str(diff(a, b))
+    assert_equal(str(diff(a, b, workers=2)), expected)
+    submitted = []
+    class Executor(ThreadPoolExecutor):
+        def submit(self, *args):
+            submitted.append(args)
+            return ThreadPoolExecutor.submit(self, *args)
+    assert_equal(str(diff(a, b, workers=Executor(2))), expected)
+    assert submitted
+    # the workers diff with the same options
+    for i in range(20):
+        a['k%d' % i]['s'] = set(['s%d' % j for j in range(10)] + [i])
+        b['k%d' % i]['s'] = set(['s%d' % j for j in range(1, 11)] + [i])
+    expected = str(diff(a, b, sort_sets=True))
+    assert_equal(str(diff(a, b, sort_sets=True, workers=2)), expected)
+    assert_equal(str(diff(a, b, sort_sets=True, workers=Executor(2))), expected)
+    # only changed values are sent to the workers
+    del submitted[:]
+    b = dict((k, v) for k, v in a.items())
+    b['k3'] = dict(a['k3'], y=-1)
+    diff(a, b, workers=Executor(2))
+    assert_equal([pair for args in submitted for pair in args[1]], [(a['k3'], b['k3'])])
+
+def test_diff_dict_workers_unpicklable():
+    # a lambda key can't go to other processes, so the diff runs serially
+    a = dict(x=[dict(id=1, v=1)], y=[dict(id=2, v=2)])
+    b = dict(x=[dict(id=1, v=3)], y=[dict(id=2, v=2)])
+    stats = datadiff.DiffStats()
+    d = diff(a, b, key=lambda item: item['id'], workers=2, stats=stats)
+    assert_equal(str(d), str(diff(a, b, key=lambda item: item['id'])))
+    assert_equal(stats.slow_paths, {'options not picklable': 1})
+
+def test_pickle_diff():
+    d = diff(list(range(100)), list(range(99)) + [0])
+    d2 = pickle.loads(pickle.dumps(d))
+    assert_equal(str(d2), str(d))
+    assert_equal(d2.diffs, d.diffs)
+
+def test_diff_to_bytes():
+    a = dict(seq=list(range(20)), nested=dict(x=[1, 2], y=(None, 0.0)), tags=set(['a', 'b']),
+             text='one\ntwo', n=-300, same=[dict(k=1)] * 2)
+    b = dict(seq=list(range(1, 21)), nested=dict(x=[1, 3], y=(None, -0.0)), tags=set(['a']),
+             text='one\n2', n=2 ** 70, same=[dict(k=1)] * 2)
+    d = diff(a, b, context=1)
+    d2 = DataDiff.from_bytes(d.to_bytes())
+    assert_equal(str(d2), str(d))
+    assert_equal([change for change, items in d2.diffs], [change for change, items in d.diffs])
+    d = diff(list(range(10)), list(range(10, 20)), max_changes=3)
+    assert_equal(str(DataDiff.from_bytes(d.to_bytes())), str(d))
+
+def test_diff_from_bytes_lazy():
+    a = dict(x=dict(i=1), y=dict(i=2))
+    b = dict(x=dict(i=3), y=dict(i=4))
+    d = DataDiff.from_bytes(diff(a, b).to_bytes())
+    assert hasattr(d, '_encoded')
+    key, x = d.diffs[0][1][0]
+    assert_equal(key, 'x')
+    assert not hasattr(d, '_encoded')
+    assert hasattr(x, '_encoded')
+    assert_equal(str(x), dedent('''\
+        --- a
+        +++ b
+        {
+        -'i': 1,
+        +'i': 3,
+        }'''))
+    assert hasattr(d.diffs[1][1][0][1], '_encoded')
+
+def test_diff_to_bytes_deep_values():
+    depth = sys.getrecursionlimit() * 2
+    value = []
+    for i in range(depth):
+        value = [value]
+    d = DataDiff.from_bytes(diff([value, 1], [value, 2]).to_bytes())
+    equal = d.diffs[1][1][0]
+    for i in range(depth):
+        equal, = equal
+    assert_equal(equal, [])
+
+@raises(ValueError)
+def test_diff_from_bytes_not_encoded():
+    DataDiff.from_bytes(b'not a diff')
+
+def test_diff_nested_multiline_strings():
+    d = diff(['a\nb', 1], ['a\nc', 1])
+    expected = dedent('''\
+        --- a
+        +++ b
+        [
+        @@ -0,1 +0,1 @@
+         '--- a\\n+++ b\\n@@ -1,2 +1,2 @@\\n a\\n-b\\n+c',
+         1,
+        ]''')
+    assert_equal(str(d), expected)
+
+def test_patch_seq():
+    a = list(range(50)) + ['x', (1, 2)]
+    b = [-1] + list(range(2, 30)) + [100, 101] + list(range(31, 50)) + ['x', (1, 3)]
+    for context in (0, 3):
+        d = diff(a, b, context=context)
+        assert_equal(patch(a, d), b)
+        assert_equal(unpatch(b, d), a)
+    assert_equal(patch(tuple(a), diff(tuple(a), tuple(b))), tuple(b))
+
+def test_patch_nested():
+    a = dict(name='x', tags=set(['a', 'b']), items=[dict(id=1), dict(id=2)],
+             text='one\ntwo\nthree', gone=1, deep=dict(x=[1, 2, 'p\nq']))
+    b = dict(name='y', tags=frozenset(['a']), items=[dict(id=1), dict(id=3), 4],
+             text='one\n2\nthree\nfour', new=None, deep=dict(x=[1, 2, 'p\nr']))
+    b['tags'] = set(b['tags'])
+    d = diff(a, b, context=0)
+    assert_equal(patch(a, d), b)
+    assert_equal(unpatch(b, d), a)
+    assert_equal(patch(a, DataDiff.from_bytes(d.to_bytes())), b)
+    assert_equal(patch(a, pickle.loads(pickle.dumps(d))), b)
+    assert_equal(a['tags'], set(['a', 'b']))
+
+def test_patch_text():
+    a = 'one\ntwo\nthree\n'
+    b = 'zero\none\nthree\nfour\n'
+    d = diff(a, b, context=1)
+    assert_equal(patch(a, d), b)
+    assert_equal(unpatch(b, d), a)
+    assert_equal(patch(a, diff(a, a)), a)
+
+@raises(PatchError)
+def test_patch_truncated():
+    a = list(range(10))
+    patch(a, diff(a, list(range(10, 20)), max_changes=2))
+
+def test_patch_strict():
+    # equal values of other types are only told apart by strict diffs
+    for a, b in [({'x': 1}, {'x': True}), ([1, 2], [1.0, 2]), ([set()], [{}]),
+                 ({'x': [1, [2]]}, {'x': [1, [2.0]]}), (set([1, 2]), set([True, 2])),
+                 ([set([1])], [set([1.0])])]:
+        d = diff(a, b, context=0, strict=True)
+        assert d
+        assert_equal(repr(patch(a, d)), repr(b))
+        assert_equal(repr(unpatch(b, d)), repr(a))
+    assert_equal(patch({'x': 1}, diff({'x': 1}, {'x': True})), {'x': 1})
+    assert not diff([[1], {'x': 2}], [[1], {'x': 2}], strict=True)
+
+def test_patch_list_for_tuple():
+    # lists and tuples aren't ==, so any diff tells them apart
+    for a, b in [([[1], 2], [(1,), 2]), ([[[1]], 2], [([1],), 2]), ([()], [[]])]:
+        d = diff(a, b, context=0)
+        assert d
+        assert_equal(repr(patch(a, d)), repr(b))
+        assert_equal(repr(unpatch(b, d)), repr(a))
+
+def make_snapshot(changed=None):
+    docs = dict(('doc%d' % i, dict(id=i, tags=['x', i], parts=[dict(n=i)], seen=set([i])))
+                for i in range(20))
+    if changed is not None:
+        docs['doc%d' % changed]['parts'][0]['n'] = -1
+    return docs
+
+def test_diff_digest_index():
+    a = make_snapshot()
+    b = make_snapshot(changed=3)
+    index = (DigestIndex(a), DigestIndex(b))
+    stats = datadiff.DiffStats()
+    d = diff(a, b, index=index, stats=stats)
+    assert_equal(str(d), str(diff(a, b)))
+    # only the changed branch is walked
+    assert_equal(stats.nodes, dict(dict=3, list=1))
+    assert_equal(DigestIndex(make_snapshot()).digest, index[0].digest)
+    assert index[0].digest != index[1].digest
+
+def test_diff_digest_index_seq():
+    a = [make_snapshot(), [1, 2], 'x']
+    b = [make_snapshot(changed=5), [1, 2], 'y', make_snapshot()]
+    d = diff(a, b, index=(DigestIndex(a), DigestIndex(b)))
+    assert_equal(str(d), str(diff(a, b)))
+
+def test_diff_digest_index_lists_and_tuples():
+    # digests tell [] from (), and so must plain diffs, to pair items the same way
+    for a, b in [([[1.5], ()], [[], ('x\nz\nw',)]), ([[], (1,)], [(), [1]])]:
+        d = diff(a, b, index=(DigestIndex(a), DigestIndex(b)))
+        assert_equal(str(d), str(diff(a, b)))
+
+def test_diff_digest_index_equal_items():
+    # digests differ for 1 and 1.0, but the items are equal
+    for a, b in [([[1], [2]], [[1.0], [2]]), ([set([1])], [set([1.0])])]:
+        assert not diff(a, b, index=(DigestIndex(a), DigestIndex(b)))
+    a, b = [[1], [2]], [[1.0], [2]]
+    d = diff(a, b, fromfile="x", tofile="y", index=(DigestIndex(a), DigestIndex(b)))
+    expected = dedent('''\
+        --- x
+        +++ y
+        [
+        @@ -0,1 +0,1 @@
+         [1],
+         [2],
+        ]''')
+    assert_equal(str(d), expected)
+
+def test_digest_index_save():
+    a = make_snapshot()
+    index = DigestIndex(a)
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        index.save(path)
+        loaded = DigestIndex.load(path)
+    finally:
+        os.remove(path)
+    assert_equal(loaded.digest, index.digest)
+    b = make_snapshot(changed=7)
+    assert_equal(str(diff(a, b, index=(loaded, DigestIndex(b)))), str(diff(a, b)))
+
+def test_diff_stream():
+    a = iter([dict(id=1, v=1), dict(id=2, v=2), dict(id=3, v=3), dict(id=5, v=5)])
+    b = iter([dict(id=1, v=1), dict(id=3, v=30), dict(id=4, v=4), dict(id=5, v=[5])])
+    changes = list(datadiff.diff_stream(a, b, key='id'))
+    assert_equal([change[:2] for change in changes],
+                 [('delete', 2), ('changed', 3), ('insert', 4), ('changed', 5)])
+    assert_equal(changes[0][2], dict(id=2, v=2))
+    assert_equal(str(changes[1][2]), str(diff(dict(id=3, v=3), dict(id=3, v=30))))
+
+def test_diff_stream_types_differ():
+    changes = list(datadiff.diff_stream([(1, 'x')], [[1, 'x']], key=lambda record: record[0]))
+    assert_equal(changes, [('delete', 1, (1, 'x')), ('insert', 1, [1, 'x'])])
+
+@raises(ValueError)
+def test_diff_stream_unsorted():
+    list(datadiff.diff_stream([2, 1], [1, 2], key=lambda record: record))
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise SkipTest('numpy is not installed')
+    return numpy
+
+def test_diff_ndarray():
+    numpy = import_numpy()
+    a = numpy.arange(10.0)
+    b = a.copy()
+    b[2] = numpy.nan
+    b[3] = 30
+    a[8] = b[8] = numpy.nan
+    d = diff(a, b, fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        array([
+        @@ -0,6 +0,6 @@
+         0.0,
+         1.0,
+        -2.0,
+        -3.0,
+        +nan,
+        +30.0,
+         4.0,
+         5.0,
+         6.0,
+        @@  @@
+        ])'''))
+    assert_equal(bool(diff(a, a.copy())), False)
+
+def test_diff_ndarray_2d():
+    numpy = import_numpy()
+    a = numpy.zeros((3, 3), dtype=int)
+    b = a.copy()
+    b[2, 1] = 5
+    d = diff(a, b, context=1, fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        array([
+        @@ -5,8 +5,8 @@
+         (2, 0): 0,
+        -(2, 1): 0,
+        +(2, 1): 5,
+         (2, 2): 0,
+        ])'''))
+
+def test_diff_ndarray_tolerance():
+    numpy = import_numpy()
+    a = numpy.array([1.0, 2.0, 3.0])
+    d = datadiff.diff_ndarray(a, a + 1e-9, rtol=1e-6)
+    assert_equal(bool(d), False)
+    d = datadiff.diff_ndarray(a, a + 1e-3, rtol=1e-6)
+    assert_equal(bool(d), True)
+
+def test_diff_ndarray_objects():
+    numpy = import_numpy()
+    a = numpy.array([1, [2]], dtype=object)
+    b = numpy.array([1, [3]], dtype=object)
+    d = diff(a, b, fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        array([
+        @@ -0,1 +0,1 @@
+         1,
+        -[2],
+        +[3],
+        ])'''))
+
+def test_diff_ndarray_tolerance_non_numeric():
+    numpy = import_numpy()
+    a = numpy.array(['x', 'y'])
+    b = numpy.array(['x', 'z'])
+    assert_equal(bool(diff(a, b, rel_tol=1e-9)), True)
+    assert_equal(bool(diff(a, a.copy(), abs_tol=1)), False)
+    a = numpy.array(['2020-01-01', '2020-01-02'], dtype='datetime64[D]')
+    b = numpy.array(['2020-01-01', '2020-01-03'], dtype='datetime64[D]')
+    assert_equal(bool(diff(a, b, rel_tol=1e-9)), True)
+
+@raises(DiffTypeError)
+def test_diff_ndarray_shapes_differ():
+    numpy = import_numpy()
+    diff(numpy.zeros((2, 3)), numpy.zeros((3, 2)))
+
+def test_diff_tolerance():
+    a = dict(x=1.0, y=[0.1, 0.2, 0.3, 0.4], z=set([1.0, 2.0]))
+    b = dict(x=1.0 + 1e-12, y=[0.1, 0.2 + 1e-12, 3.0, 0.4 - 1e-12], z=set([1.0 + 1e-12, 2.0]))
+    d = diff(a, b, rel_tol=1e-9, fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        {
+         'x': 1.0,
+         'y': [
+         @@ -0,3 +0,3 @@
+          0.1,
+          0.2,
+         -0.3,
+         +3.0,
+          0.4,
+         ],
+         'z': %s1.0, 2.0%s,
+        }''') % (set_start, set_end))
+    assert_equal(bool(diff(a, b, abs_tol=1e-6)), True)
+    assert_equal(bool(diff(a, b)), True)
+    b['y'][2] = 0.3
+    assert_equal(bool(diff(a, b, abs_tol=1e-6)), False)
+
+def test_diff_tolerance_nested():
+    # close numbers in other quantization buckets make their lists differ,
+    # but diffing them finds nothing changed
+    assert_equal(bool(diff([[1.0, 7], 3], [[1.0 + 1e-13, 7], 3], rel_tol=1e-9)), False)
+    assert_equal(bool(diff([[1.0, 7], 3], [[1.1, 7], 3], rel_tol=1e-9)), True)
+
+def test_diff_set_tolerance_tuples():
+    # tuple members aren't numbers, and not mistaken for quantized ones
+    d = diff(set([(1, 2)]), set([2]), rel_tol=1e-9, fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        set([
+        -(1, 2),
+        +2,
+        ])'''))
+    assert_equal(bool(diff(set([(1, 2), 3.0]), set([(1, 2), 3.0 + 1e-12]), rel_tol=1e-9)), False)
+
+def test_hashable_tolerance():
+    assert_equal(hashable([1.0, (2.0,)], abs_tol=0.1), hashable([1.01, (2.01,)], abs_tol=0.1))
+    assert hashable([1.0], rel_tol=1e-9) != hashable([1.1], rel_tol=1e-9)
+
+def test_register_diff():
+    class Point(object):
+        def __init__(self, x, y):
+            self.x = x
+            self.y = y
+    class Point3D(Point):
+        pass
+    def diff_point(a, b, context, depth, fromfile, tofile, _run):
+        return diff(vars(a), vars(b), context, depth, fromfile, tofile, _run=_run)
+    datadiff.register_diff(Point, diff_point)
+    d = diff([Point(1, 2)], [Point(1, 3)], fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        [
+        @@ -0 +0 @@
+         {
+          'x': 1,
+         -'y': 2,
+         +'y': 3,
+         },
+        ]'''))
+    assert_equal(str(diff(Point3D(1, 2), Point3D(1, 3))), str(diff(Point(1, 2), Point(1, 3))))
+
+def test_diff_stats():
+    stats = datadiff.DiffStats()
+    a = dict(x=[1, 2, 3], y=dict(z=1))
+    b = dict(x=[1, 2, 4], y=dict(z=2))
+    d = diff(a, b, stats=stats)
+    text = d.stringify(stats=stats)
+    assert_equal(stats.nodes, dict(dict=2, list=1))
+    assert_equal(stats.max_depth, 1)
+    assert_equal(stats.chars_rendered, len(text))
+    assert_equal(sorted(stats.times), ['dict sort', 'diff', 'fingerprint', 'match', 'render'])
+    assert 'nodes: dict=2, list=1' in str(stats)
+
+def test_diff_stats_slow_paths():
+    class Rejected(object):
+        pass
+    def reject(a, b, context, depth, fromfile, tofile, _run):
+        raise DiffTypeError('no')
+    datadiff.register_diff(Rejected, reject)
+    stats = datadiff.DiffStats()
+    diff([Rejected(), 1], [Rejected(), 2], key='id', stats=stats)
+    assert_equal(stats.slow_paths, {'nested diff failed': 1, 'items without keys': 1})
+
+def test_diff_stats_workers():
+    a = dict(('k%d' % i, dict(x=[1, 2, i], y=i)) for i in range(1, 21))
+    b = dict(('k%d' % i, dict(x=[1, 2, -i], y=i)) for i in range(1, 21))
+    serial = datadiff.DiffStats()
+    diff(a, b, stats=serial)
+    # the workers' stats are added in
+    stats = datadiff.DiffStats()
+    diff(a, b, stats=stats, workers=2)
+    assert_equal(stats.nodes, serial.nodes)
+    assert_equal(stats.max_depth, 2)
+    assert 'parallel' in stats.times and 'match' in stats.times
+
+def test_diff_numpy_scalars():
+    numpy = import_numpy()
+    # numpy scalars have __getitem__, but aren't sequences to diff
+    stats = datadiff.DiffStats()
+    d = diff(dict(x=numpy.float64(1), y=[numpy.int64(2), 3]),
+             dict(x=numpy.float64(2), y=[numpy.int64(4), 3]), stats=stats)
+    assert_equal(len(d.diffs), 3)
+    assert_equal(stats.slow_paths, {})
+
+def test_diff_dict_mixed_key_types():
+    a = {1: 'a', 'b': 2, (3,): 3}
+    b = {1: 'c', 'b': 4, (3,): 5}
+    d = diff(a, b, fromfile="x", tofile="y")
+    assert_equal(str(d), dedent('''\
+        --- x
+        +++ y
+        {
+        -1: 'a',
+        +1: 'c',
+        -'b': 2,
+        +'b': 4,
+        -(3,): 3,
+        +(3,): 5,
+        }'''))
+
+def test_diff_dict_context_of_nested_values():
+    a = dict(a=1, b=2, c=[1, 2, 3, 4, 5, 6])
+    b = dict(a=1, b=2, c=[1, 2, 3, 4, 5, 7])
+    d = diff(a, b, context=1)
+    expected = dedent('''\
+        --- a
+        +++ b
+        {
+         'a': 1,
+         'c': [
+         @@ -3,5 +3,5 @@
+          5,
+         -6,
+         +7,
+         ],
+        @@  @@
+        }''')
+    assert_equal(str(d), expected)
+
+def test_eval_bool_nested_dict():
+    d = diff(dict(a=dict(b=1)), dict(a=dict(b=2)))
+    assert_equal(bool(d), True)
+
+def test_diff_dict_shared_values():
+    class Uncomparable(object):
+        def __eq__(self, other):
+            raise AssertionError("shared values shouldn't be compared")
+        __ne__ = __eq__
+        __hash__ = object.__hash__
+    shared = Uncomparable()
+    a = dict(a=1, b=shared)
+    b = dict(a=2, b=shared)
+    d = diff(a, b, fromfile="x", tofile="y")
+    expected = dedent('''\
+        --- x
+        +++ y
+        {
+        -'a': 1,
+        +'a': 2,
+         'b': %r,
+        }''') % shared
+    assert_equal(str(d), expected)
+
+def test_diff_dict_equal_nested_values():
+    a = dict(a=[1, 2], b=dict(c=(3, 4)), d='x\ny', e=1)
+    b = dict(a=[1, 2], b=dict(c=(3, 4)), d='x\ny', e=1.0)
+    assert_equal(bool(diff(a, b)), False)
+
+def test_iter_lines():
+    a = dict(a=1, b=[1, dict(c=2)], d=dict(e=3))
+    b = dict(a=1, b=[1, dict(c=3)], d=dict(e=4))
+    d = diff(a, b)
+    lines = d.iter_lines()
+    assert_equal(next(lines), '--- a')
+    assert_equal(list(lines), str(d).split('\n')[1:])
+
+def test_write_to():
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    d = diff(dict(a=[1, 2]), dict(a=[1, 3]))
+    out = StringIO()
+    d.write_to(out)
+    assert_equal(out.getvalue(), str(d))
+
+def test_first_difference():
+    from datadiff import first_difference
+    a = dict(a=1, b=[1, 2, dict(c=set([3]))], d='x')
+    assert_equal(first_difference(a, dict(a=1, b=[1, 2, dict(c=set([3]))], d='x')), None)
+    assert_equal(first_difference(a, dict(a=1, b=[1, 2, dict(c=set([4]))], d='x')), ('b', 2, 'c'))
+    assert_equal(first_difference(a, dict(a=1, b=[1, 2], d='x')), ('b', 2))
+    assert_equal(first_difference(a, dict(a=1, b=[1, 2, dict(c=set([3]))])), ('d',))
+    assert_equal(first_difference(a, dict(a=1.0, b=[1, 2, dict(c=set([3]))], d='x', e=2)), ('e',))
+    assert_equal(first_difference([1, [2, 3]], [1, [2, 3, 4]]), (1, 2))
+    assert_equal(first_difference([1], (1,)), ())
+
+def test_differs():
+    from datadiff import differs
+    assert_equal(differs([1, dict(a=2)], [1, dict(a=2)]), False)
+    assert_equal(differs([1, dict(a=2)], [1, dict(a=3)]), True)
+    # other mappings and sets are walked like diff() walks them
+    from collections import OrderedDict
+    assert_equal(differs(OrderedDict(x=1), OrderedDict(x=2)), True)
+    assert_equal(differs([OrderedDict(x=[1])], [OrderedDict(x=[1])]), False)
+    assert_equal(differs(frozenset([1]), frozenset([2])), True)
+
+def test_diff_max_changes():
+    a = dict(a=list(range(10)), b=1, c=2, d=3)
+    b = dict(a=[-x for x in range(10)], b=2, c=3, d=4)
+    d = diff(a, b, max_changes=3, fromfile="x", tofile="y")
+    expected = dedent('''\
+        --- x
+        +++ y
+        {
+         'a': [
+         @@ -0,9 +0,9 @@
+          0,
+         -1,
+         -2,
+         -3,
+         +-1,
+         +-2,
+         +-3,
+         @@ diff truncated @@
+         ],
+        @@ diff truncated @@
+        }''')
+    assert_equal(str(d), expected)
+    assert_equal(bool(d), True)
+
+def test_diff_set_max_changes():
+    d = diff(set([1, 2, 3]), set([4, 5, 6]), max_changes=2)
+    changes = [line for line in d.iter_lines(include_preamble=False) if line[0] in '-+']
+    assert_equal(len(changes), 2)
+    assert str(d).endswith('@@ diff truncated @@\n])')
+
+def test_diff_set_sorted():
+    a = set(['b', 1, 'a', (1, 2), 3])
+    b = set(['c', 2, 'a', (1, 3), 3, 0])
+    d = diff(a, b, context=1, fromfile="x", tofile="y", sort_sets=True)
+    expected = dedent('''\
+        --- x
+        +++ y
+        set([
+        -1,
+        -'b',
+        -(1, 2),
+        +0,
+        +2,
+        +'c',
+        +(1, 3),
+         3,
+        @@  @@
+        ])''')
+    assert_equal(str(d), expected)
+
+def test_diff_set_counts():
+    assert_equal(datadiff.diff_set_counts(set([1, 2, 3]), set([2, 3, 4, 5])), (1, 2, 2))
+    assert_equal(datadiff.diff_set_counts(frozenset(), set([1])), (0, 1, 0))
+
+def test_diff_max_time():
+    a = list(range(100))
+    b = [-x for x in a]
+    d = diff(a, b, max_time=0, fromfile="x", tofile="y")
+    expected = dedent('''\
+        --- x
+        +++ y
+        [
+        @@ diff truncated @@
+        ]''')
+    assert_equal(str(d), expected)
+
+def test_diff_dict_equal_sets():
+    a = dict(a=set([1, 2]), b=set())
+    b = dict(a=set([1, 2]), b=set())
+    assert_equal(str(diff(a, b, fromfile="x", tofile="y")), dedent('''\
+        --- x
+        +++ y
+        {
+         'a': %s1, 2%s,
+         'b': set(),
+        }''') % (set_start, set_end))
+
+def test_diff_deeper_than_recursion_limit():
+    from datadiff import hashable
+    depth = sys.getrecursionlimit() * 2
+    a = [1]
+    b = [2]
+    for i in range(depth):
+        a = [a, dict(i=i)]
+        b = [b, dict(i=i)]
+    hashable(a)
+    lines = [line.strip() for line in diff(a, b).iter_lines()]
+    assert_equal(lines.count('-1,'), 1)
+    assert_equal(lines.count('+2,'), 1)
+    assert_equal(lines.count('],'), depth)
+
+def test_diff_dict_deeper_than_recursion_limit():
+    depth = sys.getrecursionlimit() * 2
+    a = [1]
+    a2 = [1]
+    b = [2]
+    for i in range(depth):
+        a = [a]
+        a2 = [a2]
+        b = [b]
+    assert not diff(dict(x=a), dict(x=a2))
+    lines = [line.strip() for line in diff(dict(x=a), dict(x=b)).iter_lines()]
+    assert_equal(lines.count('-1,'), 1)
+    assert_equal(lines.count('+2,'), 1)
+
+def test_diffs_view():
+    d = diff([1, 2, [3, 4]], [1, 5, [3]])
+    assert_equal(d.diffs[:3], (('context', [0, 2, 0, 2]), ('equal', [1]), ('delete', [2])))
+    assert_equal(d.diffs[3][0], 'insert')
+    assert_equal(d.diffs[4][0], 'datadiff')
+    d2 = DataDiff(list, '[', ']')
+    d2.diffs = d.diffs
+    assert_equal(str(d2), str(d))
+    # changes go through assigning, not changing the view in place
+    assert_raises(AttributeError, lambda: d2.diffs.append(('insert', [6])))
+    d2.diffs = list(d.diffs) + [('insert', [6])]
+    assert_equal(str(d2).splitlines()[-2], '+6,')
+
+def test_compact_representation():
+    from datadiff import dictitem
+    d = diff(dict(a=1), dict(a=2))
+    assert not hasattr(d, '__dict__')
+    assert not hasattr(d.diffs[0][1][0], '__dict__')
+    assert_equal(type(d.diffs[0][1][0]), dictitem)
+
+def test_diff_seq_references_source():
+    a = list(range(100))
+    b = list(a)
+    b[50] = -1
+    d = diff(a, b)
+    assert_equal(d.diffs[1], ('equal', [47, 48, 49]))
+    a[48] = 'changed later'
+    assert_equal(d.diffs[1], ('equal', [47, 'changed later', 49]))
+
+def test_diff_memoryview():
+    d = diff(memoryview(b'abcdef'), memoryview(b'abXdef'), fromfile="x", tofile="y")
+    expected = dedent('''\
+        --- x
+        +++ y
+        memoryview([
+        @@ -0,5 +0,5 @@
+         97,
+         98,
+        -99,
+        +88,
+         100,
+         101,
+         102,
+        ])''')
+    assert_equal(str(d), expected)
@@ -66,6 +66,27 @@ def test_assert_equal_simple_types():
     else:
         raise AssertionError("Should've raised an AssertionError")
 
+def test_assert_equal_max_changes():
+    try:
+        tools.assert_equals(list(range(10)), list(range(10, 20)), max_changes=2)
+    except:
+        e = sys.exc_info()[1]
+        assert_equal(type(e), AssertionError)
+        assert_equal(str(e), dedent('''\
+            
+            --- a
+            +++ b
+            [
+            @@ -0,9 +0,9 @@
+            -0,
+            -1,
+            +10,
+            +11,
+            @@ diff truncated @@
+            ]'''))
+    else:
+        raise AssertionError("Should've raised an AssertionError")
+
 
 if __name__ == '__main__':
     try: